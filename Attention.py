@@ -20,13 +20,15 @@ plt.switch_backend('agg')
 
 from model_architectures import Encoder_RNN, Decoder_RNN
 from data_prep import prepareData, tensorsFromPair, prepareNonTrainDataForLanguagePair, load_cpickle_gc
-from inference import generate_translation
+from inference import generate_translation, test_model, attention_memory
 from misc import timeSince, load_cpickle_gc
+from batching import BucketBatchSampler, TokenBudgetBatchSampler, TokenMeter, pair_lengths, pad_batch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 BATCH_SIZE = 32
+MAX_TOKENS = None  # e.g. 2000: batches hold up to this many padded source + target tokens instead of BATCH_SIZE pairs
 PAD_token = 0
 PAD_TOKEN = 0
 SOS_token = 1
@@ -57,25 +59,8 @@ def language_pair_dataset_collate_function(batch):
     Customized function for DataLoader that dynamically pads the batch so that all 
     data have the same length
     """
-    sent1_list = []
-    sent1_length_list = []
-    sent2_list = []
-    sent2_length_list = []
-    # padding
-    # NOW PAD WITH THE MAXIMUM LENGTH OF THE FIRST and second batches 
-    max_length_1 = max([len(x[0]) for x in batch])
-    max_length_2 = max([len(x[1]) for x in batch])
-    for datum in batch:
-        padded_vec_1 = np.pad(np.array(datum[0]).T.squeeze(), pad_width=((0,max_length_1-len(datum[0]))), 
-                                mode="constant", constant_values=PAD_token)
-        padded_vec_2 = np.pad(np.array(datum[1]).T.squeeze(), pad_width=((0,max_length_2-len(datum[1]))), 
-                                mode="constant", constant_values=PAD_token)
-        sent1_list.append(padded_vec_1)
-        sent2_list.append(padded_vec_2)
-        sent1_length_list.append(len(datum[0]))
-        sent2_length_list.append(len(datum[1]))
-    return [torch.from_numpy(np.array(sent1_list)), torch.cuda.LongTensor(sent1_length_list), 
-            torch.from_numpy(np.array(sent2_list)), torch.cuda.LongTensor(sent2_length_list)]
+    # CPU tensors, the training loop moves them to the device. Pinned when there is a GPU to copy to
+    return pad_batch(batch, PAD_token, pin_memory=torch.cuda.is_available())
 
 
 
@@ -137,25 +122,32 @@ class Attn(nn.Module):
             self.attn = nn.Linear(self.hidden_size * 2, hidden_size)
             self.v = nn.Parameter(torch.FloatTensor(1, hidden_size))
 
-    def forward(self, hidden, encoder_outputs):
-
+    def forward(self, hidden, encoder_outputs, mask=None):
+        """
+        @param mask: optional batch_size x max_len tensor, False at the padded encoder positions
+                     (those get no attention)
+        """
         # Create variable to store attention energies
         # hidden is 32 by 256
         # encoder_outputs is 32 by 72 by 256
         hidden = hidden[0]
         batch_size = hidden.size()[0]
-        attn_energies = []
-        for i in range(batch_size):
-            attn_energies.append(self.score(hidden[i], encoder_outputs[i]))
+        if self.method == 'dot':
+            # one batched matmul instead of a score per row
+            attn_energies = torch.bmm(encoder_outputs, hidden.unsqueeze(2)).squeeze(2)
+        elif self.method == 'general':
+            attn_energies = torch.bmm(self.attn(encoder_outputs), hidden.unsqueeze(2)).squeeze(2)
+        else:
+            attn_energies = []
+            for i in range(batch_size):
+                attn_energies.append(self.score(hidden[i], encoder_outputs[i]))
+            attn_energies = torch.stack(attn_energies)
+        if mask is not None:
+            attn_energies = attn_energies.masked_fill(~mask, float("-inf"))
         
         # attn_energies is 32 by 72
-        attn_energies = self.softmax(torch.stack(attn_energies))
-        
-        context_vectors = []
-        for i in range(batch_size):
-            context_vectors.append(torch.matmul(attn_energies[i], encoder_outputs[i]))
-                
-        context_vectors = torch.stack(context_vectors)
+        attn_energies = self.softmax(attn_energies)
+        context_vectors = torch.bmm(attn_energies.unsqueeze(1), encoder_outputs).squeeze(1)
         
         return context_vectors
     
@@ -213,8 +205,9 @@ class LuongAttnDecoderRNN(nn.Module):
         if attn_model != 'none':
             self.attn = Attn(attn_model, hidden_size)
 
-    def forward(self, input_seq, last_hidden, encoder_outputs):
+    def forward(self, input_seq, last_hidden, encoder_outputs, encoder_mask=None):
         # Note: we run this one step at a time
+        # encoder_mask is False at the padded encoder positions, see inference.attention_memory
 
         # Get the embedding of the current input word (last output word)
         batch_size = input_seq.size(0)
@@ -227,7 +220,7 @@ class LuongAttnDecoderRNN(nn.Module):
 
         # Calculate attention from current RNN state and all encoder outputs;
         # apply to encoder outputs to get weighted average
-        context = self.attn(rnn_output, encoder_outputs)
+        context = self.attn(rnn_output, encoder_outputs, encoder_mask)
         # context is 32 by 256
 
         # Attentional vector using the RNN hidden state and context vector
@@ -264,14 +257,16 @@ def trainIters(encoder, decoder, n_epochs, pairs, validation_pairs, lang1, lang2
     criterion = nn.NLLLoss(ignore_index=PAD_token) # this ignores the padded token. 
     plot_loss =[]
     val_loss = []
+    tokens = TokenMeter()
     for epoch in range(n_epochs):
         plot_loss = []
         val_loss = []
         for step, (sent1s, sent1_lengths, sent2s, sent2_lengths) in enumerate(train_loader):
             encoder.train()
             decoder.train()
-            sent1_batch, sent2_batch = sent1s.to(device), sent2s.to(device) 
-            sent1_length_batch, sent2_length_batch = sent1_lengths.to(device), sent2_lengths.to(device)
+            sent1_batch, sent2_batch = sent1s.to(device, non_blocking=True), sent2s.to(device, non_blocking=True) # the collate function pins them on GPU machines
+            sent1_length_batch, sent2_length_batch = sent1_lengths.to(device, non_blocking=True), sent2_lengths.to(device, non_blocking=True)
+            tokens.update(sent1_lengths, sent2_lengths)
             
             encoder_optimizer.zero_grad()
             decoder_optimizer.zero_grad()
@@ -279,8 +274,10 @@ def trainIters(encoder, decoder, n_epochs, pairs, validation_pairs, lang1, lang2
             encoder_outputs, encoder_hidden = encoder(sent1_batch, sent1_length_batch)
             # outputs is 32 by 72 by 256
             # encoder_hidden is 1 by 32 by 256
+            encoder_outputs, encoder_mask = attention_memory(encoder_outputs, sent1_lengths)
             
-            decoder_input = torch.LongTensor([SOS_token] * BATCH_SIZE).view(-1, 1).to(device)
+            # the last batch can be smaller than BATCH_SIZE
+            decoder_input = torch.LongTensor([SOS_token] * sent1_batch.size(0)).view(-1, 1).to(device)
             decoder_hidden = encoder_hidden
             # decoder_input is 32 by 1
             # decoder_hidden is 1 by 32 by 256
@@ -291,7 +288,7 @@ def trainIters(encoder, decoder, n_epochs, pairs, validation_pairs, lang1, lang2
             # Run through decoder one time step at a time using TEACHER FORCING=1.0
             for t in range(max_trg_len):
                 decoder_output, decoder_hidden = decoder(
-                    decoder_input, decoder_hidden, encoder_outputs
+                    decoder_input, decoder_hidden, encoder_outputs, encoder_mask
                 )
                 # decoder_output is 32 by vocab_size
                 # sent2_batch is 32 by 46
@@ -313,13 +310,22 @@ def trainIters(encoder, decoder, n_epochs, pairs, validation_pairs, lang1, lang2
                 print_loss_total = 0
                 print('TRAIN SCORE %s (%d %d%%) %.4f' % (timeSince(start, step / n_epochs),
                                              step, step / n_epochs * 100, print_loss_avg))
-                # 42s
-#                 v_loss = test_model(encoder, decoder, search, validation_pairs, lang2, max_length=max_length_generation)
-                # returns bleu score
-#                 print("VALIDATION BLEU SCORE: "+str(v_loss))
-#                 val_loss.append(v_loss)
+                print("%.0f tokens/sec" % tokens.tokens_per_sec())
+                tokens.reset()
                 plot_loss.append(print_loss_avg)
                 plot_loss_total = 0
+        print("PADDING RATIO %.3f (%.3f without bucketing)" % train_loader.batch_sampler.padding_ratio())
+        # a beam search pass over the validation set takes a while, so only once per epoch. 
+        # (BackgroundValidator would need this script to be importable, it trains at import time)
+        encoder.eval()
+        decoder.eval()
+        v_loss = test_model(encoder, decoder, search, validation_pairs, lang2, max_length=max_length_generation)
+        # returns bleu score
+        print("VALIDATION BLEU SCORE (epoch %d): %s" % (epoch, v_loss))
+        val_loss.append(v_loss)
+        plot_losses.append(plot_loss)
+        val_losses.append(val_loss)
+        tokens.reset()  # leave the validation out of the tokens/sec
                 
 
     save_model(encoder, decoder, val_losses, plot_losses, title)
@@ -363,8 +369,13 @@ val_pairs = load_cpickle_gc("val_pairs")
 
 train_dataset = LanguagePairDataset(train_idx_pairs)
 # is there anything in the train_idx_pairs that is only 0s right now instead of padding. 
+# batches of similar lengths, reshuffled every epoch
+if MAX_TOKENS is not None:
+    train_sampler = TokenBudgetBatchSampler(*pair_lengths(train_idx_pairs), max_tokens=MAX_TOKENS)
+else:
+    train_sampler = BucketBatchSampler(*pair_lengths(train_idx_pairs), batch_size=BATCH_SIZE)
 train_loader = torch.utils.data.DataLoader(dataset=train_dataset, 
-                                           batch_size=BATCH_SIZE, 
+                                           batch_sampler=train_sampler, 
                                            collate_fn=language_pair_dataset_collate_function,
                                           )
 
@@ -383,7 +394,8 @@ args = {
     'lang1': input_lang, 
     'lang2': target_lang,
     "pairs":train_idx_pairs, 
-    "validation_pairs": val_idx_pairs[:200], 
+    # test_model wants the source indices and the reference sentence
+    "validation_pairs": [(val_idx_pairs[i][0], val_pairs[i][1]) for i in range(200)], 
     "title": "Training Curve for Basic 1-Directional Encoder Decoder Model With LR = 0.0001",
     "max_length_generation": 20, 
     "plot_every": 10, 
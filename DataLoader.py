@@ -3,7 +3,6 @@
 import pickle
 import pdb 
 import numpy as np
-import pandas as pd
 import pprint
 import numpy as np
 from operator import itemgetter
@@ -12,7 +11,8 @@ import torch
 from torch.utils.data import Dataset
 import _pickle as cPickle
 import gc
-from sklearn.preprocessing import OneHotEncoder
+import time
+import argparse
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 MAX_SENTENCE_LENGTH_FIRST = 50 
@@ -20,6 +20,8 @@ MAX_SENTENCE_LENGTH_SECOND = 28
 EMBED_DIM = 300
 SOS_token = 2
 EOS_token = 3
+CHECK_COLLATE = False  # True makes translation_collate_func_concat assert that it paired every source with its target
+TRUNCATION_POLICIES = ("eos", "cut", "drop")
 
 def load_cpickle_gc(dirlink):
     # https://stackoverflow.com/questions/26860051/how-to-reduce-the-time-taken-to-load-a-pickle-file-in-python
@@ -41,18 +43,29 @@ class TranslationDataset(Dataset):
     Note that this class inherits torch.utils.data.Dataset
     """
     
-    def __init__(self, data_list, lang1, lang2):
+    def __init__(self, data_list, lang1, lang2, max_source_length=None, max_target_length=None, truncation="eos"):
         """
         @param data_list: list of the preprocessed tokens, so fro
         Inspired by https://discuss.pytorch.org/t/train-simultaneously-on-two-datasets/649
         Pass in lang1 and lang2 
+        @param max_source_length, max_target_length: optional caps on the # of tokens of a sentence, EOS included 
+        (e.g. MAX_SENTENCE_LENGTH_FIRST/SECOND) 
+        @param truncation: what happens to a sentence over its cap. "eos" keeps its first max - 1 tokens and the EOS, 
+        "cut" keeps its first max tokens, "drop" leaves the pair out of the dataset 
         """
-
-        self.datasets = self.tensorsFromPairs(data_list, lang1, lang2)
+        if truncation not in TRUNCATION_POLICIES:
+            raise ValueError("truncation must be one of %s, not %s" % (TRUNCATION_POLICIES, truncation))
+        self.truncation = truncation
+        source_tensors, target_tensors = self.tensorsFromPairs(data_list, lang1, lang2)
+        self.datasets = self.applyCaps(source_tensors, target_tensors, max_source_length, max_target_length)
+        if len(data_list) > 0 and len(self.datasets[0]) == 0:
+            raise ValueError("truncation=\"drop\" dropped all %d pairs, every one is longer than max_source_length=%s "
+                             "or max_target_length=%s" % (len(data_list), max_source_length, max_target_length))
+        # only for information, batches are padded to their own longest sentences
         lengths_source = [len(x) for x in self.datasets[0]]
-        self.max_sourcelength = max(lengths_source)
+        self.max_sourcelength = max(lengths_source) if lengths_source else 0
         lengths_target = [len(x) for x in self.datasets[1]]
-        self.max_targetlength = max(lengths_target)
+        self.max_targetlength = max(lengths_target) if lengths_target else 0
 
     def __len__(self):
         return len(self.datasets[0])
@@ -77,10 +90,26 @@ class TranslationDataset(Dataset):
         # outputs the batc
         return [source_tensors, target_tensors]
 
+    def truncate(self, sentence, max_length):
+        if max_length is None or len(sentence) <= max_length:
+            return sentence
+        if self.truncation == "eos":
+            return sentence[:max_length - 1] + [EOS_token]
+        return sentence[:max_length]
+
+    def applyCaps(self, source_tensors, target_tensors, max_source_length, max_target_length):
+        if self.truncation == "drop":
+            kept = [i for i in range(len(source_tensors))
+                    if (max_source_length is None or len(source_tensors[i]) <= max_source_length)
+                    and (max_target_length is None or len(target_tensors[i]) <= max_target_length)]
+            return [[source_tensors[i] for i in kept], [target_tensors[i] for i in kept]]
+        return [[self.truncate(x, max_source_length) for x in source_tensors],
+                [self.truncate(x, max_target_length) for x in target_tensors]]
+
     def __getitem__(self, key):
         sentences = tuple(d[key] for d in self.datasets)
         lengths = tuple(len(d[key]) for d in self.datasets)
-        return [sentences, lengths, self.max_sourcelength, self.max_targetlength]
+        return [sentences, lengths]
 
 def get_order(sorted_list, to_construct):
     order = []
@@ -102,6 +131,19 @@ def get_index(query_list, in_list):
             return i
     return -1
 
+def sort_order(lengths):
+    # sorted(..., key=len, reverse=True) keeps ties in their original order, so the argsort has to be stable too
+    return np.argsort(-np.asarray(lengths), kind="stable")
+
+def pad_in_order(sentences, lengths, order, max_length):
+    """ @returns len(order) x max_length array, row i is sentences[order[i]] padded with 0s """
+    lengths = np.asarray(lengths)[order]
+    padded = np.zeros((len(order), max_length), dtype=np.int64)
+    # the mask is True on the real tokens, row by row, in the same order as the concatenated sentences
+    mask = np.arange(max_length)[None, :] < lengths[:, None]
+    padded[mask] = np.concatenate([sentences[i] for i in order])
+    return padded
+
 def translation_collate_func_concat(batch):
     """
     Customized function for DataLoader that dynamically pads the batch so that all 
@@ -109,7 +151,35 @@ def translation_collate_func_concat(batch):
     Here, similar to teh way we used index_select to re-arrange the two sentence sin hw2, 
     we want to rearrange the encoder outputs to match the traget, so rearragne bseed on teh 
     target's indices hwer the target is the "true" order. 
+    Both sides are sorted by decreasing length and padded to the longest sentence of the batch, and 
+    order_target_for_source[i] is the row of the sorted sources that goes with row i of the sorted targets. 
+    The sentences of the dataset aren't modified. 
     """
+    sources = [datum[0][0] for datum in batch]
+    targets = [datum[0][1] for datum in batch]
+    length_list_first = np.array([datum[1][0] for datum in batch])
+    length_list_second = np.array([datum[1][1] for datum in batch])
+    source_order = sort_order(length_list_first)
+    target_order = sort_order(length_list_second)
+    # position of every pair among the sorted sources, taken in the order of the sorted targets
+    source_rank = np.empty_like(source_order)
+    source_rank[source_order] = np.arange(len(batch))
+    order_target_for_source = source_rank[target_order]
+
+    max_first, max_second = int(length_list_first.max()), int(length_list_second.max())
+    data_first = pad_in_order(sources, length_list_first, source_order, max_first)
+    data_second = pad_in_order(targets, length_list_second, target_order, max_second)
+    if CHECK_COLLATE:
+        expected = pad_in_order(sources, length_list_first, target_order, max_first)
+        assert np.array_equal(data_first[order_target_for_source], expected), "sources and targets don't line up"
+
+    return [torch.from_numpy(data_first), torch.from_numpy(data_second), torch.from_numpy(length_list_first[source_order]),
+            torch.from_numpy(length_list_second[target_order]), torch.from_numpy(order_target_for_source)]
+
+def reference_collate_func_concat(batch):
+    # the old translation_collate_func_concat, quadratic in the batch size, it pads the dataset's lists in place 
+    # and to the longest sentences of the corpus (batch[0][2] and batch[0][3] held them). Only used to check and 
+    # time the new one, on copies of the batch
     first_data_list = []
     second_data_list = []
     length_list_first = []
@@ -160,3 +230,36 @@ def translation_collate_func_concat(batch):
 
     return [torch.LongTensor(data_list_first), torch.LongTensor(data_list_second), torch.LongTensor(length_first),  torch.LongTensor(length_second), torch.LongTensor( order_target_for_source)]
 
+def benchmark_collate(batch_sizes, n_batches=5, seed=0):
+    rng = np.random.RandomState(seed)
+    n = max(batch_sizes) * n_batches
+    lengths = np.minimum(rng.lognormal(3, 0.6, size=(n, 2)).astype(int) + 2, 200)
+    max_source, max_target = int(lengths[:, 0].max()), int(lengths[:, 1].max())
+    # what TranslationDataset.__getitem__ returned (with the corpus maxima), with random ids so the old check never mismatches
+    data = [[(list(rng.randint(4, 30000, size=l1)), list(rng.randint(4, 30000, size=l2))), (l1, l2), max_source, max_target]
+            for l1, l2 in lengths]
+    for batch_size in batch_sizes:
+        batches = [data[i:i + batch_size] for i in range(0, batch_size * n_batches, batch_size)]
+        copies = [[[(list(s), list(t)), l, m1, m2] for (s, t), l, m1, m2 in batch] for batch in batches]
+        start = time.time()
+        expected = [reference_collate_func_concat(batch) for batch in copies]
+        reference_time = time.time() - start
+        start = time.time()
+        collated = [translation_collate_func_concat(batch) for batch in batches]
+        new_time = time.time() - start
+        # the old version pads to the corpus maxima, the new one to the batch maxima
+        identical = all(torch.equal(x[0][:, :y[0].size(1)], y[0]) and torch.equal(x[1][:, :y[1].size(1)], y[1])
+                        and all(torch.equal(a, b) for a, b in zip(x[2:], y[2:])) for x, y in zip(expected, collated))
+        old_size = sum(x[0].numel() + x[1].numel() for x in expected) / float(n_batches)
+        new_size = sum(y[0].numel() + y[1].numel() for y in collated) / float(n_batches)
+        print("batch size %d: %.1f -> %.1f ms/batch, %.0f -> %.0f sentence pairs/sec (%.0fx), "
+              "%.0f -> %.0f padded tokens/batch, identical: %s" % (
+            batch_size, 1000 * reference_time / n_batches, 1000 * new_time / n_batches, batch_size * n_batches / reference_time,
+            batch_size * n_batches / new_time, reference_time / new_time, old_size, new_size, identical))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[256, 512, 1024])
+    parser.add_argument("--n_batches", type=int, default=5, help="the old version takes seconds per batch of 1024")
+    args = parser.parse_args()
+    benchmark_collate(args.batch_sizes, args.n_batches)
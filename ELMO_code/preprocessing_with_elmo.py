@@ -18,7 +18,10 @@ from underthesea import word_tokenize
 import jieba
 import pdb
 import os
+import sys
 from elmoformanylangs import Embedder
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from normalization import elmo_normalizer
 import math
 EMBED_DIM = 1024
 
@@ -123,19 +126,11 @@ def tokenize_en(sentence):
 token_funcs = {"en": tokenize_en, "vi": tokenize_vi, "zh": tokenize_zh}
 # Turn a Unicode string to plain ASCII, thanks to
 # http://stackoverflow.com/a/518232/2809427
-def unicodeToAscii(s):
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', s)
-        if unicodedata.category(c) != 'Mn'
-    )
-
 # Lowercase, trim, and remove non-letter characters
+# (normalization.py at the root of the repo, without keeping apostrophes)
 
 def normalizeString(s):
-    s = unicodeToAscii(s.lower().strip())
-    s = re.sub(r"([.!?])", r" \1", s)
-    s = re.sub(r"[^a-zA-Z.!?]+", r" ", s)
-    return s
+    return elmo_normalizer(s)
 # so normalize the string. 
 def tokenize_indices(lang1, lang2, dataset, index, reverse=False):
     print("Reading lines...")
@@ -38,6 +38,7 @@ plt.switch_backend('agg')
 # from model_architectures import Encoder_RNN, Decoder_RNN
 from data_prep import prepareData, tensorsFromPair, prepareNonTrainDataForLanguagePair, load_cpickle_gc
 from misc import timeSince, load_cpickle_gc
+from batching import pad_batch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -141,25 +142,8 @@ def language_pair_dataset_collate_function(batch):
     Customized function for DataLoader that dynamically pads the batch so that all 
     data have the same length
     """
-    sent1_list = []
-    sent1_length_list = []
-    sent2_list = []
-    sent2_length_list = []
-    # padding
-    # NOW PAD WITH THE MAXIMUM LENGTH OF THE FIRST and second batches 
-    max_length_1 = max([len(x[0]) for x in batch])
-    max_length_2 = max([len(x[1]) for x in batch])
-    for datum in batch:
-        padded_vec_1 = np.pad(np.array(datum[0]).T.squeeze(), pad_width=((0,max_length_1-len(datum[0]))), 
-                                mode="constant", constant_values=PAD_token)
-        padded_vec_2 = np.pad(np.array(datum[1]).T.squeeze(), pad_width=((0,max_length_2-len(datum[1]))), 
-                                mode="constant", constant_values=PAD_token)
-        sent1_list.append(padded_vec_1)
-        sent2_list.append(padded_vec_2)
-        sent1_length_list.append(len(datum[0]))
-        sent2_length_list.append(len(datum[1]))
-    return [torch.from_numpy(np.array(sent1_list)), torch.cuda.LongTensor(sent1_length_list), 
-            torch.from_numpy(np.array(sent2_list)), torch.cuda.LongTensor(sent2_length_list)]
+    # CPU tensors, the training loop moves them to the device
+    return pad_batch(batch, PAD_token)
 
 
 # In[12]:
@@ -182,14 +166,14 @@ class Decoder_RNN(nn.Module):
     def __init__(self, output_size, hidden_size):
         super(Decoder_RNN, self).__init__()
         self.hidden_size = hidden_size
-        self.embedding = nn.Embedding(output_size, hidden_size).cuda()
-        self.gru = nn.GRU(hidden_size, hidden_size).cuda()
-        self.out = nn.Linear(hidden_size, output_size).cuda()
-        self.softmax = nn.LogSoftmax(dim=1).cuda()
+        self.embedding = nn.Embedding(output_size, hidden_size).to(device)
+        self.gru = nn.GRU(hidden_size, hidden_size).to(device)
+        self.out = nn.Linear(hidden_size, output_size).to(device)
+        self.softmax = nn.LogSoftmax(dim=1).to(device)
 
     def forward(self, input, hidden):
         embed = self.embedding(input).view(1, 1, -1)
-        embed = F.relu(embed).cuda()
+        embed = F.relu(embed).to(device)
         output, hidden = self.gru(embed, hidden)
         output = self.softmax(self.out(output[0]))
         return output, hidden
@@ -220,7 +204,7 @@ class SupEncoder(nn.Module):
 
         a = a[:,0,:]
         a = a.unsqueeze(1)
-        a = a.cuda()
+        a = a.to(device)
 #         pdb.set_trace()
 #         print(np.shape(a))
         return a
@@ -248,7 +232,7 @@ class Encoder(nn.Module):
         
     def forward(self, x, mask):
         "Pass the input (and mask) through each layer in turn."
-        x = x.cuda()
+        x = x.to(device)
         for layer in self.layers:
             x = layer(x, mask)
         return self.norm(x)
@@ -267,10 +251,10 @@ class LayerNorm(nn.Module):
         self.eps = eps
 
     def forward(self, x):
-        x = x.cuda()
+        x = x.to(device)
         mean = x.mean(-1, keepdim=True)
         std = x.std(-1, keepdim=True)
-        return (self.a_2 * (x - mean) / (std + self.eps) + self.b_2).cuda()
+        return (self.a_2 * (x - mean) / (std + self.eps) + self.b_2).to(device)
 
 
 # In[45]:
@@ -288,7 +272,7 @@ class SublayerConnection(nn.Module):
 
     def forward(self, x, sublayer):
         "Apply residual connection to any sublayer with the same size."
-        x = x.cuda()
+        x = x.to(device)
         return (x + self.dropout(sublayer(self.norm(x))))
 
 
@@ -306,7 +290,7 @@ class EncoderLayer(nn.Module):
 
     def forward(self, x, mask):
         "Follow Figure 1 (left) for connections."
-        x = x.cuda()
+        x = x.to(device)
         x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask))
         return self.sublayer[1](x, self.feed_forward)
 
@@ -319,7 +303,7 @@ def attention(query, key, value, mask=None, dropout=None):
     d_k = query.size(-1)
     scores = torch.matmul(query, key.transpose(-2, -1))              / math.sqrt(d_k)
     if mask is not None:
-        mask = mask.cuda()
+        mask = mask.to(device)
         scores = scores.masked_fill(mask == 0, -1e9)
     p_attn = F.softmax(scores, dim = -1)
     if dropout is not None:
@@ -344,9 +328,9 @@ class MultiHeadedAttention(nn.Module):
         
     def forward(self, query, key, value, mask=None):
         "Implements Figure 2"
-        query = query.cuda()
-        key = key.cuda()
-        value = value.cuda()
+        query = query.to(device)
+        key = key.to(device)
+        value = value.to(device)
         if mask is not None:
             # Same mask applied to all h heads.
             mask = mask.unsqueeze(1)
@@ -361,7 +345,7 @@ class MultiHeadedAttention(nn.Module):
                                  dropout=self.dropout)
         
         # 3) "Concat" using a view and apply a final linear. 
-        x = x.cuda()
+        x = x.to(device)
         x = x.transpose(1, 2).contiguous()              .view(nbatches, -1, self.h * self.d_k)
         
         return self.linears[-1](x)
@@ -374,13 +358,13 @@ class PositionwiseFeedForward(nn.Module):
     "Implements FFN equation."
     def __init__(self, d_model, d_ff, dropout=0.1):
         super(PositionwiseFeedForward, self).__init__()
-        self.w_1 = nn.Linear(d_model, d_ff).cuda()
-        self.w_2 = nn.Linear(d_ff, d_model).cuda()
-        self.dropout = nn.Dropout(dropout).cuda()
+        self.w_1 = nn.Linear(d_model, d_ff).to(device)
+        self.w_2 = nn.Linear(d_ff, d_model).to(device)
+        self.dropout = nn.Dropout(dropout).to(device)
 
     def forward(self, x):
-        x = x.cuda()
-        return self.w_2(self.dropout(F.relu(self.w_1(x)).cuda()))
+        x = x.to(device)
+        return self.w_2(self.dropout(F.relu(self.w_1(x)).to(device)))
 
 
 # In[50]:
@@ -389,12 +373,12 @@ class PositionwiseFeedForward(nn.Module):
 class Embeddings(nn.Module):
     def __init__(self, d_model, vocab):
         super(Embeddings, self).__init__()
-        self.lut = nn.Embedding(vocab, d_model).cuda()
+        self.lut = nn.Embedding(vocab, d_model).to(device)
         self.d_model = d_model
 
     def forward(self, x):
         # x is the weights here
-        x = x.cuda()
+        x = x.to(device)
         return self.lut(x) * math.sqrt(self.d_model)
 
 
@@ -408,11 +392,11 @@ class PositionalEncoding(nn.Module):
         self.dropout = nn.Dropout(p=dropout)
         
         # Compute the positional encodings once in log space.
-        pe = torch.zeros(max_len, d_model).cuda()
-        position = torch.arange(0., max_len).unsqueeze(1).cuda()
+        pe = torch.zeros(max_len, d_model).to(device)
+        position = torch.arange(0., max_len).unsqueeze(1).to(device)
         div_term = torch.exp(torch.arange(0., d_model, 2) *
                              -(math.log(10000.0) / d_model))
-        div_term = div_term.cuda()
+        div_term = div_term.to(device)
 #         pdb.set_trace()
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
@@ -422,7 +406,7 @@ class PositionalEncoding(nn.Module):
         
     def forward(self, x):
 #         pdb.set_trace()
-        x = x.cuda()
+        x = x.to(device)
         x = x + Variable(self.pe[:, :x.size(1)],requires_grad=False)
 
         return self.dropout(x)
@@ -604,11 +588,11 @@ N = 1
 h=8
 dropout=0.1
 "Helper: Construct a model from hyperparameters."
-attn = MultiHeadedAttention(h, hidden_size).cuda()
-ff = PositionwiseFeedForward(hidden_size,input_lang.n_words, dropout).cuda()
-position = PositionalEncoding(hidden_size, dropout).cuda()
-src_embed = nn.Sequential(Embeddings(hidden_size, input_lang.n_words), position).cuda()
-encoder1 = SupEncoder(Encoder(EncoderLayer(hidden_size, attn, ff, dropout), N),src_embed).cuda()
+attn = MultiHeadedAttention(h, hidden_size).to(device)
+ff = PositionwiseFeedForward(hidden_size,input_lang.n_words, dropout).to(device)
+position = PositionalEncoding(hidden_size, dropout).to(device)
+src_embed = nn.Sequential(Embeddings(hidden_size, input_lang.n_words), position).to(device)
+encoder1 = SupEncoder(Encoder(EncoderLayer(hidden_size, attn, ff, dropout), N),src_embed).to(device)
 
 
 # In[57]:
@@ -721,7 +705,7 @@ def beam_search(decoder, decoder_input, hidden, max_length, k, target_lang):
 # In[63]:
 
 
-decoder1 = Decoder_RNN(target_lang.n_words,hidden_size).cuda()
+decoder1 = Decoder_RNN(target_lang.n_words,hidden_size).to(device)
 args = {
     'n_epochs': 10,
     'learning_rate': 0.001,
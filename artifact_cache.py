@@ -0,0 +1,121 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+# Content-addressed store for preprocessing outputs.
+# An artifact is a directory named after the sha1 of everything that determines its content: the
+# input files (their bytes, not their paths), MAX_LENGTH, NORMALIZATION_VERSION and the vocabulary
+# options. Building an artifact that already exists is skipped; otherwise it is built in a temporary
+# directory and renamed into place, so a crashed run never leaves half an artifact behind.
+# manifest.json maps a name (e.g. "iwslt-vi-eng") to the artifact built last under that name, so
+# training scripts can find their data with locate() without hashing anything.
+
+ARTIFACT_ROOT = "preprocessed_data_no_elmo/artifacts"
+MANIFEST = "manifest.json"
+MANIFEST_LOCK = "manifest.lock"
+FORMAT_VERSION = 1  # bump when the layout of an artifact changes
+
+
+def file_sha1(path):
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def artifact_key(input_files, settings):
+    """
+    @param input_files: paths of every file the artifact is built from, always in the same order
+    @param settings: JSON serializable dict of everything else that changes the output
+    """
+    description = {"format": FORMAT_VERSION,
+                   "inputs": [file_sha1(path) for path in input_files],
+                   "settings": settings}
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def write_json(path, content):
+    # atomic: readers see the old file or the new one, never a partial one
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class ArtifactCache:
+    def __init__(self, root=ARTIFACT_ROOT):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.path(key), "meta.json"))
+
+    def build(self, name, input_files, settings, build_fn):
+        """
+        @param build_fn: build_fn(directory) writes the artifact's files into directory and returns a dict
+                         {file name: path relative to directory} of what it wrote
+        @returns the artifact directory, and whether it had to be built
+        """
+        key = artifact_key(input_files, settings)
+        directory = self.path(key)
+        built = False
+        if not self.exists(key):
+            os.makedirs(self.root, exist_ok=True)
+            tmp_directory = tempfile.mkdtemp(dir=self.root, prefix=".tmp-" + key[:8] + "-")
+            try:
+                files = build_fn(tmp_directory)
+                write_json(os.path.join(tmp_directory, "meta.json"), {
+                    "key": key, "name": name, "settings": settings, "files": files,
+                    "inputs": {path: file_sha1(path) for path in input_files}, "created": time.time()})
+                os.rename(tmp_directory, directory)
+                built = True
+            except BaseException as error:
+                shutil.rmtree(tmp_directory, ignore_errors=True)
+                # the rename fails if someone else built the same artifact in the meantime, that's fine
+                if not (isinstance(error, OSError) and self.exists(key)):
+                    raise
+        self.update_manifest(name, key)
+        return directory, built
+
+    def manifest(self):
+        path = os.path.join(self.root, MANIFEST)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def update_manifest(self, name, key):
+        with open(os.path.join(self.path(key), "meta.json")) as f:
+            meta = json.load(f)
+        # read-modify-write under an exclusive lock, so concurrent preprocess.py runs don't drop each other's entries
+        with open(os.path.join(self.root, MANIFEST_LOCK), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                manifest = self.manifest()
+                manifest[name] = {"key": key, "settings": meta["settings"], "files": meta["files"]}
+                write_json(os.path.join(self.root, MANIFEST), manifest)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def locate(self, name):
+        """
+        @returns {file name: path} of the artifact that manifest.json has for name
+        raises KeyError if there is none (run preprocess.py first)
+        """
+        manifest = self.manifest()
+        if name not in manifest:
+            raise KeyError("no artifact called %s in %s, run preprocess.py" % (name, os.path.join(self.root, MANIFEST)))
+        directory = self.path(manifest[name]["key"])
+        return {file_name: os.path.join(directory, path) for file_name, path in manifest[name]["files"].items()}
+
+
+def locate(name, root=ARTIFACT_ROOT):
+    return ArtifactCache(root).locate(name)
@@ -0,0 +1,143 @@
+import copy
+import queue
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+import inference
+from inference import validation_bleu
+
+# Runs validation BLEU in a separate process so trainIters never stops to decode the validation set.
+# The training loop hands over a snapshot of the encoder/decoder state_dicts tagged with the step
+# that produced it, and picks the scores up whenever they are ready.
+# Snapshots never pile up in memory: besides the one the worker is validating, one sits in the queue and
+# the newest one is kept by the training process until the queue has room. If validation is slower than
+# training, a new snapshot replaces the one kept back, which is never validated (its score is NaN).
+# The worker is started with "spawn", so training scripts that use it need an
+# if __name__ == "__main__": guard around their module-level code.
+
+
+class TargetVocab:
+    """
+    The parts of a target Lang that decoding needs. The Lang classes in the training scripts live
+    in __main__, so we send a plain copy to the worker instead of pickling the Lang itself.
+    """
+    def __init__(self, lang):
+        self.name = lang.name
+        self.index2word = dict(lang.index2word)
+        self.word2index = dict(lang.word2index)
+        self.n_words = lang.n_words
+
+
+def snapshot(model):
+    """ CPU copy of the state_dict, so training can keep updating the weights """
+    return {name: tensor.detach().cpu().clone() for name, tensor in model.state_dict().items()}
+
+
+def validation_worker(encoder, decoder, validation_pairs, lang2, search, max_length, bpe, num_threads, tasks, results):
+    torch.set_num_threads(num_threads)
+    encoder = encoder.to(inference.device).eval()
+    decoder = decoder.to(inference.device).eval()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        step, encoder_state, decoder_state = task
+        try:
+            encoder.load_state_dict(encoder_state)
+            decoder.load_state_dict(decoder_state)
+            with torch.no_grad():
+                bleu = validation_bleu(encoder, decoder, search, validation_pairs, lang2, max_length=max_length,
+                                       bpe=bpe).score()
+        except Exception:
+            # the training process raises it, a NaN score would hide that validation can't work
+            results.put((step, None, traceback.format_exc()))
+            continue
+        results.put((step, bleu, None))
+
+
+class BackgroundValidator:
+    """
+    validator = BackgroundValidator(encoder, decoder, validation_pairs, lang2, search)
+    validator.submit((epoch, step), encoder, decoder)   # returns right away
+    for step, bleu in validator.poll(): ...              # whatever has finished so far
+    validator.wait()                                     # blocks until every snapshot is scored
+    validator.scores[(epoch, step)]
+    A score is NaN when the snapshot was skipped: a newer one was submitted before the worker had room for it,
+    so it was never validated (its step is in validator.skipped). It is not a BLEU of 0, plots should leave
+    it out (np.nanmax, matplotlib leaves a gap). submit and poll never block.
+    Raises RuntimeError if the worker fails to validate a snapshot.
+    """
+    def __init__(self, encoder, decoder, validation_pairs, lang2, search, max_length=None, num_threads=1, bpe=None):
+        """ @param bpe: the target BPE if lang2 is a subword vocabulary (see validation_bleu) """
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue(maxsize=1)
+        self.results = context.Queue()
+        self.scores = {}
+        self.skipped = []
+        self.pending = 0  # snapshots in the queue or being validated
+        self.waiting = None  # newest snapshot, kept here until the queue has room
+        self.process = context.Process(
+            target=validation_worker,
+            args=(copy.deepcopy(encoder).cpu(), copy.deepcopy(decoder).cpu(), validation_pairs, TargetVocab(lang2),
+                  search, max_length, bpe, num_threads, self.tasks, self.results),
+            daemon=True)
+        self.process.start()
+
+    def submit(self, step, encoder, decoder):
+        if self.waiting is not None:
+            # the worker never had room for it, the newer snapshot replaces it
+            stale_step = self.waiting[0]
+            self.scores[stale_step] = float("nan")
+            self.skipped.append(stale_step)
+        self.waiting = (step, snapshot(encoder), snapshot(decoder))
+        self._hand_over(block=False)
+
+    def _hand_over(self, block):
+        """ puts the waiting snapshot in the queue, if there is one and the queue has room (or once it has, if block) """
+        while self.waiting is not None:
+            try:
+                self.tasks.put(self.waiting, block=block, timeout=5 if block else None)
+            except queue.Full:
+                if not block:
+                    return
+                if not self.process.is_alive():
+                    raise RuntimeError("validation worker died with %d snapshots pending" % (self.pending + 1))
+                continue
+            self.waiting = None
+            self.pending += 1
+
+    def _collect(self, block):
+        self._hand_over(block)
+        finished = []
+        while self.pending > 0:
+            try:
+                step, bleu, error = self.results.get(block=block, timeout=5 if block else None)
+            except queue.Empty:
+                if not block:
+                    break
+                if not self.process.is_alive():
+                    raise RuntimeError("validation worker died with %d snapshots pending" % self.pending)
+                continue
+            self.pending -= 1
+            if error is not None:
+                raise RuntimeError("validation of snapshot %s failed in the worker:\n%s" % (step, error))
+            self.scores[step] = bleu
+            finished.append((step, bleu))
+            # the worker took a snapshot out of the queue, so there is room for the waiting one
+            self._hand_over(block=False)
+        return finished
+
+    def poll(self):
+        """ @returns list of (step, bleu) that finished since the last call, never blocks """
+        return self._collect(block=False)
+
+    def wait(self):
+        """ @returns list of (step, bleu) that finished since the last call, after all of them are done """
+        return self._collect(block=True)
+
+    def close(self):
+        finished = self.wait()
+        self.tasks.put(None)
+        self.process.join()
+        return finished
@@ -0,0 +1,248 @@
+import argparse
+import time
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+# Batch samplers for the training DataLoaders, pass them as DataLoader(dataset, batch_sampler=..., collate_fn=...).
+# BucketBatchSampler puts pairs of similar source/target length in the same batch, so
+# language_pair_dataset_collate_function pads (and the encoder/decoder compute) much less.
+# TokenBudgetBatchSampler does the same but fills every batch up to a number of (padded) tokens instead of
+# a number of sentences, so short sentences come in big batches and long ones in small batches, and
+# TokenMeter measures the tokens/sec to tune that budget with.
+# pad_batch is the collate function: it returns CPU tensors (optionally pinned or in shared memory) and
+# the training loop moves them to the model's device.
+# python batching.py   (pad_batch vs the old np.pad collate function at batch sizes 16 to 512)
+
+
+def pair_lengths(pairs, max_length=None):
+    """
+    @param pairs: list of (source, target) or a MemmapCorpus
+    @param max_length: the dataset truncates sentences to this many tokens (vanilla's LanguagePairDataset does)
+    @returns source_lengths, target_lengths as numpy arrays
+    """
+    if hasattr(pairs, "source_lengths"):
+        source_lengths, target_lengths = np.asarray(pairs.source_lengths), np.asarray(pairs.target_lengths)
+    else:
+        source_lengths = np.array([len(pair[0]) for pair in pairs])
+        target_lengths = np.array([len(pair[1]) for pair in pairs])
+    if max_length is not None:
+        source_lengths, target_lengths = np.minimum(source_lengths, max_length), np.minimum(target_lengths, max_length)
+    return source_lengths, target_lengths
+
+
+def padding_ratio(batches, source_lengths, target_lengths):
+    """ fraction of the padded source + target tensors of the batches that is padding """
+    real, padded = 0, 0
+    for batch in batches:
+        for lengths in [source_lengths[batch], target_lengths[batch]]:
+            real += lengths.sum()
+            padded += lengths.max() * len(batch)
+    return 1. - real / float(padded) if padded else 0.
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, source_lengths, target_lengths, batch_size, pool_size=100, shuffle=True, drop_last=False, seed=0):
+        """
+        Every epoch the pairs are shuffled and cut into pools of pool_size batches. Each pool is sorted by
+        (source length, target length) and cut into batches, and the order of all the batches is shuffled.
+        @param pool_size: # of batches sorted together, bigger pools mean less padding but less random batches
+        @param shuffle: False sorts the whole dataset once and always gives the same batches
+        """
+        self.source_lengths = np.asarray(source_lengths)
+        self.target_lengths = np.asarray(target_lengths)
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def pool_length(self):
+        return self.batch_size * self.pool_size
+
+    def split(self, chunk):
+        """ cuts a chunk of indices sorted by length into batches """
+        return [chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size)]
+
+    def make_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        n = len(self.source_lengths)
+        indices = rng.permutation(n) if self.shuffle else np.arange(n)
+        pool = n if not self.shuffle else self.pool_length()
+        batches = []
+        for start in range(0, n, pool):
+            chunk = indices[start:start + pool]
+            # lexsort sorts by the last key first, and it is stable so ties stay shuffled
+            chunk = chunk[np.lexsort((self.target_lengths[chunk], self.source_lengths[chunk]))]
+            batches.extend(self.split(chunk))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        self.batches = self.make_batches()
+        self.epoch += 1
+        for batch in self.batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        n = len(self.source_lengths)
+        if not self.drop_last:
+            pool = n if not self.shuffle else self.batch_size * self.pool_size
+            # every pool ends with its own partial batch
+            return sum((min(pool, n - start) + self.batch_size - 1) // self.batch_size for start in range(0, n, pool))
+        return len(self.make_batches())
+
+    def padding_ratio(self):
+        """ padding ratio of the batches of the current (or last) epoch, and of sequential batches for comparison """
+        batches = self.batches if self.batches is not None else self.make_batches()
+        # sequential batches of the same average size
+        batch_size = max(1, int(round(len(self.source_lengths) / float(max(1, len(batches))))))
+        sequential = [np.arange(i, min(i + batch_size, len(self.source_lengths)))
+                      for i in range(0, len(self.source_lengths), batch_size)]
+        return (padding_ratio(batches, self.source_lengths, self.target_lengths),
+                padding_ratio(sequential, self.source_lengths, self.target_lengths))
+
+
+class TokenBudgetBatchSampler(BucketBatchSampler):
+    def __init__(self, source_lengths, target_lengths, max_tokens, pool_size=10000, shuffle=True, seed=0):
+        """
+        Batches hold as many pairs as fit in max_tokens source + target tokens, padding included, i.e.
+        len(batch) * (longest source + longest target) <= max_tokens. A pair longer than the budget gets a batch
+        of its own. Pairs are shuffled and sorted by length in pools like in BucketBatchSampler.
+        @param max_tokens: token budget of a batch
+        @param pool_size: # of pairs sorted together
+        """
+        super(TokenBudgetBatchSampler, self).__init__(source_lengths, target_lengths, None, pool_size=pool_size,
+                                                      shuffle=shuffle, seed=seed)
+        self.max_tokens = max_tokens
+        self.cache = (None, None)  # (epoch, batches), the batches depend on the epoch's shuffle
+
+    def pool_length(self):
+        return self.pool_size
+
+    def split(self, chunk):
+        batches = []
+        start, max_source, max_target = 0, 0, 0
+        for i, idx in enumerate(chunk):
+            source, target = max(max_source, self.source_lengths[idx]), max(max_target, self.target_lengths[idx])
+            if i > start and (i - start + 1) * (source + target) > self.max_tokens:
+                batches.append(chunk[start:i])
+                start, source, target = i, self.source_lengths[idx], self.target_lengths[idx]
+            max_source, max_target = source, target
+        if start < len(chunk):
+            batches.append(chunk[start:])
+        return batches
+
+    def make_batches(self):
+        if self.cache[0] != self.epoch:
+            self.cache = (self.epoch, super(TokenBudgetBatchSampler, self).make_batches())
+        return self.cache[1]
+
+    def __len__(self):
+        # the # of batches changes a little from epoch to epoch
+        return len(self.make_batches())
+
+
+class TokenMeter:
+    """ counts the real (not padding) source + target tokens of the batches trained on """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.tokens = 0
+        self.start = time.time()
+
+    def update(self, sent1_lengths, sent2_lengths):
+        self.tokens += int(sent1_lengths.sum()) + int(sent2_lengths.sum())
+
+    def tokens_per_sec(self):
+        return self.tokens / max(time.time() - self.start, 1e-9)
+
+
+def pad_side(sentences, pad_token=0, pin_memory=False, share_memory=False):
+    """
+    @param sentences: list of 1-D long tensors
+    @returns batch_size x longest sentence padded tensor, lengths
+    """
+    lengths = torch.tensor([len(sentence) for sentence in sentences], dtype=torch.long)
+    # one buffer for the whole batch. Pinned memory needs CUDA, so it's ignored on CPU-only machines
+    padded = torch.empty((len(sentences), int(lengths.max())), dtype=torch.long,
+                         pin_memory=pin_memory and torch.cuda.is_available())
+    if share_memory:
+        padded.share_memory_()
+    padded.fill_(pad_token)
+    # the mask is True on the real tokens, row by row, in the same order as the concatenated sentences
+    mask = torch.arange(padded.size(1)).unsqueeze(0) < lengths.unsqueeze(1)
+    padded[mask] = torch.cat(sentences)
+    return padded, lengths
+
+
+def pad_batch(batch, pad_token=0, pin_memory=False, share_memory=False):
+    """
+    Collate function for the LanguagePairDatasets: pads the batch to its longest source/target sentence.
+    @param batch: list of [source, target, ...], the sentences are tensors (n x 1 or n), numpy arrays or lists of ids
+    @param pin_memory: allocate in page-locked memory, for faster (non_blocking) copies to the GPU
+    @param share_memory: allocate in shared memory, saves a copy when DataLoader workers (num_workers > 0) collate
+    @returns [sources, source lengths, targets, target lengths], int64 CPU tensors
+    """
+    sources = [torch.as_tensor(datum[0], dtype=torch.long, device="cpu").view(-1) for datum in batch]
+    targets = [torch.as_tensor(datum[1], dtype=torch.long, device="cpu").view(-1) for datum in batch]
+    sent1s, sent1_lengths = pad_side(sources, pad_token, pin_memory, share_memory)
+    sent2s, sent2_lengths = pad_side(targets, pad_token, pin_memory, share_memory)
+    return [sent1s, sent1_lengths, sent2s, sent2_lengths]
+
+
+def reference_collate(batch, pad_token=0):
+    # the old language_pair_dataset_collate_function, with CPU lengths so it runs without a GPU. Only used to check pad_batch
+    max_length_1 = max([len(x[0]) for x in batch])
+    max_length_2 = max([len(x[1]) for x in batch])
+    sent1_list, sent2_list = [], []
+    for datum in batch:
+        sent1_list.append(np.pad(np.array(datum[0]).T.squeeze(), pad_width=((0, max_length_1 - len(datum[0]))),
+                                 mode="constant", constant_values=pad_token))
+        sent2_list.append(np.pad(np.array(datum[1]).T.squeeze(), pad_width=((0, max_length_2 - len(datum[1]))),
+                                 mode="constant", constant_values=pad_token))
+    return [torch.from_numpy(np.array(sent1_list)), torch.LongTensor([len(x[0]) for x in batch]),
+            torch.from_numpy(np.array(sent2_list)), torch.LongTensor([len(x[1]) for x in batch])]
+
+
+def timed(collate, batches):
+    start = time.time()
+    for batch in batches:
+        collate(batch)
+    return time.time() - start
+
+
+def benchmark_collate(batch_sizes, n_batches=50, seed=0):
+    # IWSLT-like sentence lengths, n x 1 tensors like tensorFromSentence gives
+    rng = np.random.RandomState(seed)
+    n = max(batch_sizes) * n_batches
+    lengths = np.minimum(rng.lognormal(3, 0.6, size=(n, 2)).astype(int) + 2, 200)
+    data = [[torch.from_numpy(rng.randint(4, 30000, size=(l1, 1))), torch.from_numpy(rng.randint(4, 30000, size=(l2, 1)))]
+            for l1, l2 in lengths]
+    for batch_size in batch_sizes:
+        batches = [data[i:i + batch_size] for i in range(0, batch_size * n_batches, batch_size)]
+        expected = [reference_collate(batch) for batch in batches]
+        padded = [pad_batch(batch) for batch in batches]
+        # best of 3, the first runs also pay for warming up
+        reference_time = min(timed(reference_collate, batches) for _ in range(3))
+        pad_time = min(timed(pad_batch, batches) for _ in range(3))
+        identical = all(torch.equal(a, b) for x, y in zip(expected, padded) for a, b in zip(x, y))
+        print("batch size %d: %.3f -> %.3f ms/batch (%.1fx), identical: %s" % (
+            batch_size, 1000 * reference_time / n_batches, 1000 * pad_time / n_batches, reference_time / pad_time, identical))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[16, 32, 64, 128, 256, 512])
+    parser.add_argument("--n_batches", type=int, default=50)
+    args = parser.parse_args()
+    benchmark_collate(args.batch_sizes, args.n_batches)
@@ -0,0 +1,73 @@
+import argparse
+import pickle
+import time
+import torch
+import torch.nn as nn
+
+from model_architectures import Encoder_Batch_RNN, Decoder_RNN
+from data_prep import Lang  # the Lang pickles were written from __main__
+from inference import translate_pairs, calculate_bleu, device
+
+# Compares plain beam search against the pruned variants of beam_search on the same test pairs:
+# BLEU, decoder calls per sentence and wall time.
+# python benchmark_beam.py --pairs preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_test_tokenized
+
+
+class CountingDecoder(nn.Module):
+    """ wraps a decoder and counts how many times (and on how many rows) it is called """
+    def __init__(self, decoder):
+        super(CountingDecoder, self).__init__()
+        self.decoder = decoder
+        self.calls = 0
+        self.rows = 0
+
+    def forward(self, input, hidden):
+        self.calls += 1
+        self.rows += hidden.size(1)
+        return self.decoder(input, hidden)
+
+
+SETTINGS = [
+    ("no pruning", {"early_stop": False}),
+    ("early stop", {}),
+    ("max 2 per parent", {"max_per_parent": 2}),
+    ("relative 0.6", {"relative_threshold": 0.6}),
+    ("absolute 2.5", {"absolute_threshold": 2.5}),
+    ("all", {"relative_threshold": 0.6, "absolute_threshold": 2.5, "max_per_parent": 2}),
+]
+
+
+def benchmark(encoder, decoder, test_pairs, lang2, k=5):
+    encoder_inputs = [pair[0] for pair in test_pairs]
+    true_labels = [pair[1] for pair in test_pairs]
+    max_lengths = [len(e_input) for e_input in encoder_inputs]
+    for name, options in SETTINGS:
+        counting = CountingDecoder(decoder)
+        start = time.time()
+        predictions = translate_pairs(encoder, counting, "beam", encoder_inputs, lang2, max_lengths, beam_options=options)
+        elapsed = time.time() - start
+        bleu = calculate_bleu(predictions, true_labels)
+        print("%-18s BLEU %6.2f  decoder calls/sent %6.2f  rows/sent %7.2f  %.1fs" % (
+            name, bleu, counting.calls / len(test_pairs), counting.rows / len(test_pairs), elapsed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang")
+    parser.add_argument("--target_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--pairs", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_test_tokenized")
+    parser.add_argument("--encoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingencodermodel_states")
+    parser.add_argument("--decoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingdecodermodel_states")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--n", type=int, default=500, help="# of test pairs to translate")
+    args = parser.parse_args()
+
+    input_lang = pickle.load(open(args.input_lang, "rb"))
+    target_lang = pickle.load(open(args.target_lang, "rb"))
+    test_pairs = pickle.load(open(args.pairs, "rb"))[:args.n]
+    encoder = Encoder_Batch_RNN(input_lang.n_words, args.hidden_size).to(device)
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
+    decoder = Decoder_RNN(target_lang.n_words, args.hidden_size).to(device)
+    decoder.load_state_dict(torch.load(args.decoder, map_location=device))
+    with torch.no_grad():
+        benchmark(encoder.eval(), decoder.eval(), test_pairs, target_lang)
@@ -0,0 +1,113 @@
+import math
+import numpy as np
+
+# Incremental corpus BLEU on token ids.
+# It keeps the same sufficient statistics as sacrebleu (clipped n-gram matches, n-gram totals,
+# hypothesis and reference lengths) so score() is exactly what calculate_bleu / raw_corpus_bleu
+# would return on the " ".join of the same tokens, but nothing but 10 integers is kept in memory.
+
+NGRAM_ORDER = 4
+SMOOTH_VALUE = .01  # the floor smoothing value calculate_bleu uses
+
+
+def ngram_counts(ids, n):
+    """
+    @param ids: 1-D int64 numpy array of token ids
+    @returns keys, counts: the distinct n-grams of ids (as opaque byte keys) and how often they occur
+    """
+    if len(ids) < n:
+        return np.empty(0, dtype=np.dtype((np.void, ids.itemsize * n))), np.empty(0, dtype=np.int64)
+    windows = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(ids, n))
+    # view every window of n ids as one opaque item so np.unique can count rows
+    keys = windows.view(np.dtype((np.void, ids.itemsize * n))).ravel()
+    return np.unique(keys, return_counts=True)
+
+
+class BleuAccumulator:
+    """
+    Collects BLEU statistics one sentence at a time.
+    Accumulators from several workers can be merged with merge() (or +=) and
+    score() gives the corpus BLEU of everything added so far.
+    """
+    def __init__(self, smooth_value=SMOOTH_VALUE):
+        self.smooth_value = smooth_value
+        # correct[0:4], total[4:8], sys_len, ref_len
+        self.stats = np.zeros(2 * NGRAM_ORDER + 2, dtype=np.int64)
+
+    @property
+    def correct(self):
+        return self.stats[:NGRAM_ORDER]
+
+    @property
+    def total(self):
+        return self.stats[NGRAM_ORDER:2 * NGRAM_ORDER]
+
+    @property
+    def sys_len(self):
+        return int(self.stats[-2])
+
+    @property
+    def ref_len(self):
+        return int(self.stats[-1])
+
+    def add(self, hypothesis, reference):
+        """
+        @param hypothesis: sequence of target token ids produced by the decoder
+        @param reference: sequence of target token ids of the reference translation
+        """
+        hypothesis = np.asarray(hypothesis, dtype=np.int64).ravel()
+        reference = np.asarray(reference, dtype=np.int64).ravel()
+        for n in range(1, NGRAM_ORDER + 1):
+            hyp_keys, hyp_counts = ngram_counts(hypothesis, n)
+            ref_keys, ref_counts = ngram_counts(reference, n)
+            _, hyp_idx, ref_idx = np.intersect1d(hyp_keys, ref_keys, assume_unique=True, return_indices=True)
+            self.stats[n - 1] += np.minimum(hyp_counts[hyp_idx], ref_counts[ref_idx]).sum()
+            self.stats[NGRAM_ORDER + n - 1] += hyp_counts.sum()
+        self.stats[-2] += len(hypothesis)
+        self.stats[-1] += len(reference)
+
+    def merge(self, other):
+        self.stats += other.stats
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def reset(self):
+        self.stats[:] = 0
+
+    def score(self):
+        """
+        Corpus BLEU (0-100) with floor smoothing and effective order, like sacrebleu.raw_corpus_bleu
+        """
+        precisions = [0.0] * NGRAM_ORDER
+        effective_order = NGRAM_ORDER
+        for n in range(1, NGRAM_ORDER + 1):
+            correct, total = self.correct[n - 1], self.total[n - 1]
+            if total == 0:
+                break
+            effective_order = n
+            if correct == 0:
+                precisions[n - 1] = 100. * self.smooth_value / total
+            else:
+                precisions[n - 1] = 100. * correct / total
+
+        sys_len, ref_len = self.sys_len, self.ref_len
+        if sys_len < ref_len:
+            bp = math.exp(1 - ref_len / sys_len) if sys_len > 0 else 0.0
+        else:
+            bp = 1.0
+        log_precisions = [math.log(p) if p > 0 else -9999999999 for p in precisions[:effective_order]]
+        return bp * math.exp(sum(log_precisions) / effective_order)
+
+
+def reference_ids(lang, sentence, bpe=None):
+    """
+    Turns a reference string (as made by processReference) into target ids,
+    splitting on whitespace the same way sacrebleu does
+    @param bpe: the target BPE if lang is a subword vocabulary, the words are split into its subwords first
+    """
+    words = sentence.split()
+    if bpe is not None:
+        words = bpe.encode(" ".join(words))
+    return [lang.word2index.get(word, 3) for word in words]  # 3 is UNK
@@ -0,0 +1,186 @@
+import argparse
+import heapq
+from collections import Counter
+from io import open
+
+from data_prep import iterPairs
+
+# Byte-pair encoding (Sennrich et al. 2016, "Neural Machine Translation of Rare Words with Subword Units").
+# learn_bpe learns the merges offline from the word counts of a training file, BPE splits words into
+# subwords with them. Every subword but the last one of a word ends with "@@", so
+# BPE.decode(["vi@@", "et", "nam"]) == "viet nam".
+# Splitting a word is cached, so encoding is about as fast as sentence.split(' ').
+# python bpe.py --lang vi --merges 30000
+# then tensorFromSentence(lang, sentence, bpe=BPE(path)) and test_model(..., bpe=target_bpe)
+
+END_OF_WORD = "</w>"
+SEPARATOR = "@@"
+SPECIAL_WORDS = ("PAD", "SOS", "EOS", "UNK")  # Lang's special tokens are never part of a word
+
+
+def learn_bpe(word_counts, n_merges, min_frequency=2):
+    """
+    @param word_counts: {word: count}
+    @param n_merges: max # of merges, the subword vocabulary is about n_merges + the # of characters
+    @param min_frequency: stop when the most frequent pair is seen fewer times than this
+    @returns merges: list of symbol pairs, in the order they were learned
+    """
+    words = [list(word[:-1]) + [word[-1] + END_OF_WORD] for word in word_counts if word]
+    counts = [word_counts[word] for word in word_counts if word]
+    pair_counts = Counter()
+    pair_words = {}  # pair -> indices of the words it occurs in
+    for i, symbols in enumerate(words):
+        for pair in zip(symbols, symbols[1:]):
+            pair_counts[pair] += counts[i]
+            pair_words.setdefault(pair, set()).add(i)
+    # max heap with lazy deletion: an entry is stale if its count isn't the pair's current count
+    heap = [(-count, pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while len(merges) < n_merges and heap:
+        count, pair = heapq.heappop(heap)
+        if -count != pair_counts.get(pair, 0):
+            continue
+        if -count < min_frequency:
+            break
+        merges.append(pair)
+        merged = pair[0] + pair[1]
+        changed = set()
+        for i in pair_words.pop(pair, ()):
+            symbols = words[i]
+            for old in zip(symbols, symbols[1:]):
+                pair_counts[old] -= counts[i]
+                changed.add(old)
+            new_symbols = []
+            j = 0
+            while j < len(symbols):
+                if j + 1 < len(symbols) and symbols[j] == pair[0] and symbols[j + 1] == pair[1]:
+                    new_symbols.append(merged)
+                    j += 2
+                else:
+                    new_symbols.append(symbols[j])
+                    j += 1
+            words[i] = new_symbols
+            for new in zip(new_symbols, new_symbols[1:]):
+                pair_counts[new] += counts[i]
+                pair_words.setdefault(new, set()).add(i)
+                changed.add(new)
+        del pair_counts[pair]
+        for changed_pair in changed:
+            if pair_counts.get(changed_pair, 0) > 0:
+                heapq.heappush(heap, (-pair_counts[changed_pair], changed_pair))
+            elif changed_pair in pair_counts:
+                del pair_counts[changed_pair]
+                pair_words.pop(changed_pair, None)
+    return merges
+
+
+def save_merges(path, merges):
+    with open(path, "w", encoding="utf-8") as f:
+        for left, right in merges:
+            f.write(left + " " + right + "\n")
+
+
+def load_merges(path):
+    with open(path, encoding="utf-8") as f:
+        return [tuple(line.rstrip("\n").split(" ")) for line in f if line.strip()]
+
+
+class BPE:
+    def __init__(self, merges):
+        """ @param merges: list of pairs from learn_bpe, or the path of a merges file """
+        if isinstance(merges, str):
+            self.path = merges
+            merges = load_merges(merges)
+        else:
+            self.path = None
+        self.ranks = {pair: rank for rank, pair in enumerate(merges)}
+        self.cache = {}
+
+    def encode_word(self, word):
+        subwords = self.cache.get(word)
+        if subwords is not None:
+            return subwords
+        if not word:
+            subwords = [word]
+        else:
+            symbols = list(word[:-1]) + [word[-1] + END_OF_WORD]
+            while len(symbols) > 1:
+                # apply the earliest learned merge that is possible
+                pairs = [(self.ranks.get(pair), j) for j, pair in enumerate(zip(symbols, symbols[1:]))]
+                rank, j = min(((rank, j) for rank, j in pairs if rank is not None), default=(None, None))
+                if rank is None:
+                    break
+                pair = (symbols[j], symbols[j + 1])
+                new_symbols = []
+                k = 0
+                while k < len(symbols):
+                    if k + 1 < len(symbols) and (symbols[k], symbols[k + 1]) == pair:
+                        new_symbols.append(symbols[k] + symbols[k + 1])
+                        k += 2
+                    else:
+                        new_symbols.append(symbols[k])
+                        k += 1
+                symbols = new_symbols
+            symbols[-1] = symbols[-1][:-len(END_OF_WORD)]
+            subwords = [symbol + SEPARATOR for symbol in symbols[:-1]] + [symbols[-1]]
+        self.cache[word] = subwords
+        return subwords
+
+    def encode(self, sentence):
+        """ @returns list of subwords, the words are split on ' ' like Lang.addSentence does """
+        subwords = []
+        for word in sentence.split(' '):
+            subwords.extend(self.encode_word(word))
+        return subwords
+
+    def encode_sentence(self, sentence):
+        return " ".join(self.encode(sentence))
+
+    def decode(self, subwords):
+        """
+        @returns the sentence (a string), subwords is a list like the one encode returns.
+        Decoder output can be malformed: a word cut short by the max length, or followed by EOS, ends
+        where it was cut instead of swallowing the next token
+        """
+        words = []
+        current = ""
+        for subword in subwords:
+            if subword in SPECIAL_WORDS:
+                if current:
+                    words.append(current)
+                words.append(subword)
+                current = ""
+            elif subword.endswith(SEPARATOR):
+                current += subword[:-len(SEPARATOR)]
+            else:
+                words.append(current + subword)
+                current = ""
+        if current:
+            words.append(current)
+        return " ".join(words)
+
+
+def word_counts(input_file, target_file, side):
+    counts = Counter()
+    for source, target in iterPairs(input_file, target_file):
+        counts.update((source if side == "source" else target).split(' '))
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang", default="vi")
+    parser.add_argument("--merges", type=int, default=30000)
+    parser.add_argument("--min_frequency", type=int, default=2)
+    args = parser.parse_args()
+
+    # the same training files as prepareDataInitial, the english side is normalized like in the Langs
+    input_file = "iwslt-" + args.lang + "-en/train.tok." + args.lang
+    target_file = "iwslt-" + args.lang + "-en/train.tok.en"
+    for side, name in [("source", args.lang), ("target", "en")]:
+        merges = learn_bpe(word_counts(input_file, target_file, side), args.merges, args.min_frequency)
+        path = "preprocessed_data_no_elmo/iwslt-" + args.lang + "-eng/bpe_" + name + ".merges"
+        save_merges(path, merges)
+        print("%s: %d merges -> %s" % (name, len(merges), path))
@@ -0,0 +1,40 @@
+import argparse
+import resource
+import time
+
+from data_prep import Lang, convertPairsToCorpus, load_cpickle_gc, MemmapCorpus
+
+# Converts the preprocessed_no_indices_pairs_* pickles to the memmap corpus format (see data_prep.MemmapCorpus)
+# and compares loading both.
+# python convert_corpus.py --lang vi
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def compare_loading(pickle_path):
+    start = time.time()
+    corpus = MemmapCorpus(pickle_path)
+    for i in range(len(corpus)):
+        corpus[i]
+    print("memmap: %d pairs, open + read all %.2fs, max rss %.0f MB" % (len(corpus), time.time() - start, max_rss_mb()))
+    # the pickle goes last since max rss never goes down
+    start = time.time()
+    pairs = load_cpickle_gc(pickle_path)
+    print("pickle: %d pairs, load %.2fs, max rss %.0f MB" % (len(pairs), time.time() - start, max_rss_mb()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang", default="vi")
+    parser.add_argument("--datasets", nargs="+", default=["train", "validation", "test"])
+    parser.add_argument("--compare", action="store_true", help="time loading the pickle vs the memmap corpus")
+    args = parser.parse_args()
+
+    for dataset in args.datasets:
+        path = "preprocessed_data_no_elmo/iwslt-" + args.lang + "-eng/preprocessed_no_indices_pairs_" + dataset + "_tokenized"
+        n_pairs = convertPairsToCorpus(path)
+        print("%s: %d pairs -> %s.{src,tgt,ref,idx}" % (path, n_pairs, path))
+    if args.compare:
+        compare_loading("preprocessed_data_no_elmo/iwslt-" + args.lang + "-eng/preprocessed_no_indices_pairs_train_tokenized")
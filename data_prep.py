@@ -3,13 +3,19 @@ from io import open
 import unicodedata
 import string
 import re
+import os
 import random
 import numpy as np
 import torch
+from torch.utils.data import Dataset
 import pickle
 import _pickle as cPickle
 import gc
+import multiprocessing
+from collections import deque
+from itertools import islice
 import pdb 
+from normalization import normalizer, unicodeToAscii
 
 device = "cpu"
 
@@ -55,19 +61,55 @@ class Lang:
         else:
             self.word2count[word] += 1
 
-# Turn a Unicode string to plain ASCII: http://stackoverflow.com/a/518232/2809427
-def unicodeToAscii(s):
-    return ''.join(
-        c for c in unicodedata.normalize('NFD', s)
-        if unicodedata.category(c) != 'Mn'
-    )
+    def addCounts(self, counts):
+        # counts is {word: count} in order of first occurrence (see countChunk), merging the chunks
+        # in corpus order gives the same ids as calling addSentence on every line
+        for word, count in counts.items():
+            if word not in self.word2index:
+                self.word2index[word] = self.n_words
+                self.word2count[word] = count
+                self.index2word[self.n_words] = word
+                self.n_words += 1
+            else:
+                self.word2count[word] += count
+
+    def prune(self, min_count=None, max_size=None, coverage=None):
+        """
+        Smaller vocabulary for the embedding and softmax layers. Words that don't make it are not in
+        word2index anymore, so indexesFromSentence / processReference turn them into UNK.
+        The kept words keep their relative order, so with no limits the ids don't change.
+        @param min_count: drop the words seen fewer than min_count times
+        @param max_size: max n_words, the 4 special tokens included
+        @param coverage: keep the fewest (most frequent) words that cover this fraction of the running words, e.g. 0.98
+        @returns a new Lang
+        """
+        words = sorted(self.word2count, key=lambda word: (-self.word2count[word], self.word2index[word]))
+        counts = [self.word2count[word] for word in words]
+        n_kept = len(words)
+        if min_count is not None:
+            n_kept = min(n_kept, sum(1 for count in counts if count >= min_count))
+        if max_size is not None:
+            n_kept = min(n_kept, max(max_size - 4, 0))
+        if coverage is not None:
+            needed = coverage * sum(counts)
+            covered = 0
+            for i, count in enumerate(counts):
+                if covered >= needed:
+                    n_kept = min(n_kept, i)
+                    break
+                covered += count
+        pruned = Lang(self.name)
+        for word in sorted(words[:n_kept], key=self.word2index.get):
+            pruned.word2index[word] = pruned.n_words
+            pruned.word2count[word] = self.word2count[word]
+            pruned.index2word[pruned.n_words] = word
+            pruned.n_words += 1
+        return pruned
 
 # lowercase, trim, and remove non-letter characters
+# (normalization.py, cached per word, same output as before)
 def normalizeString(s):
-    s = unicodeToAscii(s.lower().strip())
-    s = re.sub(r"([.!?])", r" \1", s)
-    s = re.sub(r"[^a-zA-Z.!?']+", r" ", s)
-    return s
+    return normalizer(s)
     
 def filterPair(p):
     return len(p[0].split(' ')) < MAX_LENGTH and \
@@ -77,24 +119,77 @@ def filterPairs(pairs):
     return [pair for pair in pairs if filterPair(pair)]
 
 
+def strippedLines(path):
+    """
+    Yields the same lines as open(path).read().strip().split("\n") one at a time, without reading
+    the whole file: blank lines at the start and at the end of the file are dropped.
+    """
+    with open(path, encoding='utf-8') as file:
+        started = False
+        blank = []  # blank lines we can only yield once we know they aren't at the end of the file
+        last = None
+        for line in file:
+            line = line[:-1] if line.endswith("\n") else line
+            if not started:
+                if not line.strip():
+                    continue
+                line = line.lstrip()
+                started = True
+            if not line.strip():
+                blank.append(line)
+                continue
+            if last is not None:
+                yield last
+            for b in blank:
+                yield b
+            blank = []
+            last = line
+        if last is not None:
+            yield last.rstrip()
+        else:
+            # "".split("\n") is [""]
+            yield ""
+
+
+def firstLines(path, size):
+    # what the size branch of readLangs did: the first size lines, each one stripped
+    with open(path, encoding='utf-8') as file:
+        for line, _ in zip(file, range(size)):
+            yield line.strip()
+
+
+def iterPairs(input_file, target_file, size=None, normalize=True):
+    """
+    Yields aligned (source, normalized target) pairs, reading both files in lockstep, so memory doesn't
+    grow with the size of the corpus.
+    @param size: only the first size pairs
+    @param normalize: False leaves normalizeString to the caller (see prepareTrainCorpusParallel)
+    raises ValueError if the two files don't have the same # of lines (or fewer than size)
+    """
+    if size is None:
+        input_lines, target_lines = strippedLines(input_file), strippedLines(target_file)
+    else:
+        input_lines, target_lines = firstLines(input_file, size), firstLines(target_file, size)
+    n_pairs = 0
+    while size is None or n_pairs < size:
+        input_line = next(input_lines, None)
+        target_line = next(target_lines, None)
+        if input_line is None and target_line is None:
+            if size is not None:
+                raise ValueError("asked for %d pairs but %s and %s only have %d lines" % (size, input_file, target_file, n_pairs))
+            return
+        if input_line is None or target_line is None:
+            longer, shorter = (input_file, target_file) if target_line is None else (target_file, input_file)
+            raise ValueError("%s has more lines than %s (which has %d)" % (longer, shorter, n_pairs))
+        if size is None:
+            target_line = target_line.replace(" &apos;", "")
+        yield input_line, normalizeString(target_line) if normalize else target_line
+        n_pairs += 1
+
+
 def readLangs(input_file, target_file, input_lang, target_lang, size=None):
     print("Reading lines...")
-
-    # Read the file and split into lines
-    with open(input_file, encoding='utf-8') as file:
-        if size == None:
-            input_lines = open(input_file, encoding='utf-8').read().strip().split("\n")
-        else:
-            input_lines = [next(file).strip() for x in range(size)]
-        
-    with open(target_file, encoding='utf-8') as file:
-        if size == None:
-            target_lines = open(target_file, encoding='utf-8').read().strip().replace(" &apos;", "").split("\n")
-        else:
-            target_lines = [next(file).strip() for x in range(size)]
-        
-    target_pairs = [normalizeString(s) for s in target_lines]
-    pairs = list(zip(input_lines, target_pairs))
+    pairs = list(iterPairs(input_file, target_file, size))
     print(pairs[0])
 
     input_lang = Lang(input_lang)
@@ -102,6 +197,56 @@ def readLangs(input_file, target_file, input_lang, target_lang, size=None):
     return input_lang, target_lang, pairs
 
 
+def applyBPE(source, target, bpe=None):
+    # bpe is an optional (source BPE, target BPE) pair, see bpe.py
+    if bpe is None:
+        return source, target
+    return bpe[0].encode_sentence(source), bpe[1].encode_sentence(target)
+
+
+def buildLangs(input_file, target_file, input_lang, target_lang, size=None, bpe=None):
+    # same Langs as prepareTrainData, in one streaming pass that keeps nothing but the vocabularies
+    # with bpe, (source BPE, target BPE), the Langs are subword vocabularies
+    input_lang = Lang(input_lang)
+    target_lang = Lang(target_lang)
+    n_pairs = 0
+    for source, target in iterPairs(input_file, target_file, size):
+        source, target = applyBPE(source, target, bpe)
+        input_lang.addSentence(source)
+        target_lang.addSentence(target)
+        n_pairs += 1
+    print("Read %s sentence pairs" % n_pairs)
+    print(input_lang.name, input_lang.n_words)
+    print(target_lang.name, target_lang.n_words)
+    return input_lang, target_lang, n_pairs
+
+
+def pruneLangs(input_lang, target_lang, vocab_options=None):
+    # vocab_options: dict of Lang.prune options (min_count, max_size, coverage) for both languages
+    if not vocab_options:
+        return input_lang, target_lang
+    input_lang, target_lang = input_lang.prune(**vocab_options), target_lang.prune(**vocab_options)
+    print("Pruned to %s %d, %s %d words" % (input_lang.name, input_lang.n_words, target_lang.name, target_lang.n_words))
+    return input_lang, target_lang
+
+
+def prepareTrainCorpus(input_file, target_file, input_lang, target_lang, prefix, size=None, vocab_options=None, bpe=None):
+    """
+    Streaming version of prepareTrainData + tokenizing: one pass builds the Langs, a second one
+    tokenizes the pairs straight into the memmap corpus at prefix (see CorpusWriter).
+    Memory stays constant besides the vocabularies, whatever the size of the corpus.
+    @param vocab_options: optional dict of Lang.prune options, pruned words are tokenized as UNK
+    @param bpe: optional (source BPE, target BPE) pair to tokenize into subwords
+    """
+    input_lang, target_lang, _ = buildLangs(input_file, target_file, input_lang, target_lang, size, bpe)
+    input_lang, target_lang = pruneLangs(input_lang, target_lang, vocab_options)
+    source_bpe, target_bpe = bpe if bpe is not None else (None, None)
+    with CorpusWriter(prefix) as writer:
+        for source, target in iterPairs(input_file, target_file, size):
+            writer.add(idsFromSentence(input_lang, source, source_bpe), idsFromSentence(target_lang, target, target_bpe))
+    return input_lang, target_lang, writer.n_pairs
+
+
 def processReference(lang, sentence):
     # what this does is basicallyp prepares thee refernece and removes the <UNK> data. 
     # lang1 - str 
@@ -136,6 +281,28 @@ def prepareNonTrainDataForLanguagePair(input_file_path_dev, target_file_path_dev
         pairs.append(final_pairs)
     return pairs
 
+def iterNonTrainPairs(input_file, target_file, input_lang, target_lang, bpe=None):
+    """
+    Streaming version of the validation/test pairs of prepareDataInitial: yields (source ids, reference)
+    with the reference normalized and its unknown words replaced by UNK.
+    @param bpe: optional (source BPE, target BPE), the reference is then left as plain words
+    raises ValueError if the two files don't have the same # of lines
+    """
+    source_bpe = bpe[0] if bpe is not None else None
+    input_lines, target_lines = strippedLines(input_file), strippedLines(target_file)
+    while True:
+        source = next(input_lines, None)
+        target = next(target_lines, None)
+        if source is None and target is None:
+            return
+        if source is None or target is None:
+            raise ValueError("%s and %s don't have the same # of lines" % (input_file, target_file))
+        reference = normalizeString(target)
+        if bpe is None:
+            reference = processReference(target_lang, reference)
+        yield idsFromSentence(input_lang, source, source_bpe), reference
+
+
 def prepareDataInitial(lang1, lang2):
 # This sts up everything you need for preprocessing. 
     input_file = 'iwslt-'+lang1+'-en/train.tok.'+lang1
@@ -190,12 +357,19 @@ def indexesFromSentence(lang, sentence):
             indices.append(3) # UNK_INDEX
     return indices
 
-def tensorFromSentence(lang, sentence):
+def idsFromSentence(lang, sentence, bpe=None):
+    # the ids tensorFromSentence puts in its tensor
     sentence = sentence.replace("  ", " ")
+    if bpe is not None:
+        sentence = bpe.encode_sentence(sentence)
     indexes = [SOS_token]
     indexes.extend(indexesFromSentence(lang, sentence))
     indexes.append(EOS_token)
-    return torch.tensor(indexes, dtype=torch.long, device=device).view(-1, 1)
+    return indexes
+
+def tensorFromSentence(lang, sentence, bpe=None):
+    # bpe: optional BPE (bpe.py) that splits the words into the subwords of lang
+    return torch.tensor(idsFromSentence(lang, sentence, bpe), dtype=torch.long, device=device).view(-1, 1)
 
 
 def tensorsFromPair(pair, input_lang, target_lang):
@@ -203,3 +377,218 @@ def tensorsFromPair(pair, input_lang, target_lang):
     target_tensor = tensorFromSentence(target_lang, pair[1])
     return (input_tensor, target_tensor)
 
+
+
+# Binary corpus format: the token ids of all the sentences of one side are concatenated in a flat int32
+# file (prefix.src / prefix.tgt) and prefix.idx holds the int64 (source, target) offsets of every pair,
+# so pair i is src[idx[i, 0]:idx[i + 1, 0]], tgt[idx[i, 1]:idx[i + 1, 1]].
+# Everything is opened with np.memmap, so loading is instant and only the pages that are read end up in memory.
+# Validation/test pairs have a reference sentence instead of target ids, those go to prefix.ref, one per line.
+
+class CorpusWriter:
+    """
+    Streams pairs to disk, nothing but the current pair is kept in memory.
+    with CorpusWriter(prefix) as writer:
+        writer.add(source_ids, target_ids_or_reference)
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.source_file = open(prefix + ".src", "wb")
+        self.index_file = open(prefix + ".idx", "wb")
+        self.target_file = None
+        self.reference_file = None
+        self.offsets = np.zeros(2, dtype=np.int64)
+        self.offsets.tofile(self.index_file)
+        self.n_pairs = 0
+
+    def add(self, source, target):
+        """
+        @param source: token ids, a list or a (n, 1) tensor like tensorFromSentence's
+        @param target: token ids, or the reference sentence (str) for validation/test pairs
+        """
+        source = np.asarray(source, dtype=np.int32).ravel()
+        source.tofile(self.source_file)
+        self.offsets[0] += len(source)
+        if isinstance(target, str):
+            if self.reference_file is None:
+                self.reference_file = open(self.prefix + ".ref", "w", encoding="utf-8", newline="")
+            self.reference_file.write(target + "\n")
+        else:
+            if self.target_file is None:
+                self.target_file = open(self.prefix + ".tgt", "wb")
+            target = np.asarray(target, dtype=np.int32).ravel()
+            target.tofile(self.target_file)
+            self.offsets[1] += len(target)
+        self.offsets.tofile(self.index_file)
+        self.n_pairs += 1
+
+    def close(self):
+        for f in [self.source_file, self.index_file, self.target_file, self.reference_file]:
+            if f is not None:
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def writeCorpus(pairs, prefix):
+    with CorpusWriter(prefix) as writer:
+        for source, target in pairs:
+            writer.add(source, target)
+    return writer.n_pairs
+
+
+def convertPairsToCorpus(pickle_path, prefix=None):
+    # converts one of the preprocessed_no_indices_pairs_* pickles, the corpus goes next to it by default
+    pairs = load_cpickle_gc(pickle_path)
+    return writeCorpus(pairs, pickle_path if prefix is None else prefix)
+
+
+class MemmapCorpus(Dataset):
+    """
+    Drop-in replacement for the list of pairs from the pickles: corpus[i] is (source, target) where
+    source (and target, for training pairs) is a (n, 1) torch.long tensor and target is the reference
+    string for validation/test pairs.
+    source_lengths / target_lengths are the sentence lengths, without reading any token.
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = np.fromfile(prefix + ".idx", dtype=np.int64).reshape(-1, 2)
+        self.source_lengths = np.diff(self.index[:, 0])
+        self.target_lengths = np.diff(self.index[:, 1])
+        self.references = None
+        if os.path.exists(prefix + ".ref"):
+            with open(prefix + ".ref", encoding="utf-8", newline="") as f:
+                self.references = f.read().split("\n")[:len(self)]
+        self.source = None
+        self.target = None
+
+    def open(self):
+        # opened lazily so DataLoader workers each map the files instead of getting a pickled copy
+        # mode "c" (copy on write) gives writable arrays for torch.from_numpy without copying them
+        if self.source is None:
+            self.source = self.memmap(self.prefix + ".src")
+            if self.references is None:
+                self.target = self.memmap(self.prefix + ".tgt")
+
+    def memmap(self, path):
+        if os.path.getsize(path) == 0:
+            # np.memmap can't map an empty file
+            return np.zeros(0, dtype=np.int32)
+        return np.memmap(path, dtype=np.int32, mode="c")
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["source"] = None
+        state["target"] = None
+        return state
+
+    def __len__(self):
+        return len(self.index) - 1
+
+    def source_ids(self, key):
+        """ int32 view of the source ids of pair key, no copy """
+        self.open()
+        return self.source[self.index[key, 0]:self.index[key + 1, 0]]
+
+    def target_ids(self, key):
+        self.open()
+        return self.target[self.index[key, 1]:self.index[key + 1, 1]]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        source = torch.from_numpy(self.source_ids(key)).long().view(-1, 1)
+        if self.references is not None:
+            return source, self.references[key]
+        return source, torch.from_numpy(self.target_ids(key)).long().view(-1, 1)
+
+
+def loadPairs(path):
+    # the memmap corpus if convert_corpus.py has been run on this pickle, the pickle otherwise
+    if os.path.exists(path + ".idx"):
+        return MemmapCorpus(path)
+    return load_cpickle_gc(path)
+
+
+# Parallel version of prepareTrainCorpus. The main process only reads the raw lines and hands chunks of
+# pairs to a pool: the first pass normalizes and counts the words of every chunk, the counts are merged in
+# chunk order so the Langs are identical to the serial ones, and the second pass indexes the chunks.
+
+def chunksOf(iterator, chunk_size):
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def orderedMap(pool, func, chunks, max_pending):
+    # like pool.imap, but only reads ahead max_pending chunks instead of the whole file
+    pending = deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def countChunk(chunk):
+    """ @returns {word: count} for both sides of the chunk, in order of first occurrence """
+    source_counts, target_counts = {}, {}
+    for source, target in chunk:
+        source, target = applyBPE(source, normalizeString(target), worker_bpe)
+        for word in source.split(' '):
+            source_counts[word] = source_counts.get(word, 0) + 1
+        for word in target.split(' '):
+            target_counts[word] = target_counts.get(word, 0) + 1
+    return source_counts, target_counts
+
+
+worker_langs = None
+worker_bpe = None
+
+def setWorkerLangs(input_lang, target_lang, bpe=None):
+    global worker_langs, worker_bpe
+    worker_langs = (input_lang, target_lang)
+    worker_bpe = bpe
+
+
+def indexChunk(chunk):
+    input_lang, target_lang = worker_langs
+    source_bpe, target_bpe = worker_bpe if worker_bpe is not None else (None, None)
+    return [(idsFromSentence(input_lang, source, source_bpe), idsFromSentence(target_lang, normalizeString(target), target_bpe))
+            for source, target in chunk]
+
+
+def prepareTrainCorpusParallel(input_file, target_file, input_lang, target_lang, prefix, workers=4, size=None, chunk_size=20000,
+                               vocab_options=None, bpe=None):
+    """ same output as prepareTrainCorpus (Langs and corpus), with workers processes """
+    if workers <= 1:
+        return prepareTrainCorpus(input_file, target_file, input_lang, target_lang, prefix, size, vocab_options, bpe)
+    input_lang = Lang(input_lang)
+    target_lang = Lang(target_lang)
+    with multiprocessing.Pool(workers, initializer=setWorkerLangs, initargs=(None, None, bpe)) as pool:
+        chunks = chunksOf(iterPairs(input_file, target_file, size, normalize=False), chunk_size)
+        # the results come back in chunk order, which is what makes the merge deterministic
+        for source_counts, target_counts in orderedMap(pool, countChunk, chunks, 2 * workers):
+            input_lang.addCounts(source_counts)
+            target_lang.addCounts(target_counts)
+    print(input_lang.name, input_lang.n_words)
+    print(target_lang.name, target_lang.n_words)
+    input_lang, target_lang = pruneLangs(input_lang, target_lang, vocab_options)
+
+    with multiprocessing.Pool(workers, initializer=setWorkerLangs, initargs=(input_lang, target_lang, bpe)) as pool:
+        with CorpusWriter(prefix) as writer:
+            chunks = chunksOf(iterPairs(input_file, target_file, size, normalize=False), chunk_size)
+            for indexed in orderedMap(pool, indexChunk, chunks, 2 * workers):
+                for source_ids, target_ids in indexed:
+                    writer.add(source_ids, target_ids)
+    print("Read %s sentence pairs" % writer.n_pairs)
+    return input_lang, target_lang, writer.n_pairs
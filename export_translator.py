@@ -0,0 +1,213 @@
+import argparse
+import pickle
+import time
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model_architectures import Encoder_Batch_RNN, Decoder_RNN
+from data_prep import Lang  # the Lang pickles were written from __main__
+from inference import generate_translation
+
+# Exports a trained Encoder_Batch_RNN / Decoder_RNN pair (the state files written by save_model)
+# as one TorchScript artifact that also contains the greedy and beam decoding loops, so inference
+# doesn't pay the Python overhead of greedy_search / beam_search on every step.
+# python export_translator.py --out output/translator.pt
+# translator = load_translator("output/translator.pt"); translate(translator, sentence, max_length, target_lang, k=5)
+
+SOS_token = 1
+EOS_token = 2
+
+
+class ScriptedTranslator(nn.Module):
+    def __init__(self, encoder, decoder):
+        super(ScriptedTranslator, self).__init__()
+        self.hidden_size = decoder.hidden_size
+        self.src_embedding = encoder.embedding
+        self.src_gru = encoder.gru
+        self.tgt_embedding = decoder.embedding
+        self.tgt_gru = decoder.gru
+        self.out = decoder.out
+        self.sos = SOS_token
+        self.eos = EOS_token
+
+    def encode(self, src: torch.Tensor) -> torch.Tensor:
+        # a single sentence has no padding, so there is no need to pack it
+        _, hidden = self.src_gru(self.src_embedding(src.view(1, -1)))
+        return hidden
+
+    def step(self, decoder_input: torch.Tensor, hidden: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # same as Decoder_RNN.forward
+        embed = F.relu(self.tgt_embedding(decoder_input).view(1, -1, self.hidden_size))
+        output, hidden = self.tgt_gru(embed, hidden)
+        return F.log_softmax(self.out(output[0]), dim=1), hidden
+
+    @torch.jit.export
+    def greedy(self, src: torch.Tensor, max_length: int) -> List[int]:
+        hidden = self.encode(src)
+        decoder_input = torch.full((1, 1), self.sos, dtype=torch.long, device=src.device)
+        translation: List[int] = []
+        for i in range(max_length):
+            next_word_probs, hidden = self.step(decoder_input, hidden)
+            best_idx = int(torch.argmax(next_word_probs[0]))
+            translation.append(best_idx)
+            if best_idx == self.eos:
+                break
+            decoder_input = torch.full((1, 1), best_idx, dtype=torch.long, device=src.device)
+        return translation
+
+    @torch.jit.export
+    def beam(self, src: torch.Tensor, max_length: int, k: int) -> List[int]:
+        # same search as inference.beam_search without the pruning options
+        hidden = self.encode(src)
+        decoder_input = torch.full((1, 1), self.sos, dtype=torch.long, device=src.device)
+        scores = torch.zeros(1, device=src.device)
+        words_per_step: List[List[int]] = []
+        parents_per_step: List[List[int]] = []
+        completed_scores: List[float] = []
+        completed_steps: List[int] = []
+        completed_rows: List[int] = []
+        live_rows: List[int] = [0]
+        ran_out = True
+        for m in range(max_length):
+            next_word_probs, hidden = self.step(decoder_input, hidden)
+            per_parent = min(k, next_word_probs.size(1))
+            parent_scores, parent_words = torch.topk(scores.unsqueeze(1) + next_word_probs, per_parent, dim=1)
+            top_scores, top_idx = torch.topk(parent_scores.view(-1), min(k, parent_scores.numel()))
+            parents = top_idx // per_parent
+            words = parent_words.view(-1).index_select(0, top_idx)
+            words_list: List[int] = words.tolist()
+            parents_list: List[int] = parents.tolist()
+            scores_list: List[float] = top_scores.tolist()
+            words_per_step.append(words_list)
+            parents_per_step.append([live_rows[p] for p in parents_list])
+
+            keep: List[int] = []
+            for j in range(len(words_list)):
+                if words_list[j] == self.eos:
+                    completed_scores.append(scores_list[j])
+                    completed_steps.append(m)
+                    completed_rows.append(j)
+                else:
+                    keep.append(j)
+            k = k - (len(words_list) - len(keep))
+            if k <= 0 or len(keep) == 0:
+                ran_out = False
+                break
+
+            keep_idx = torch.tensor(keep, dtype=torch.long, device=src.device)
+            scores = top_scores.index_select(0, keep_idx)
+            hidden = hidden.index_select(1, parents.index_select(0, keep_idx))
+            decoder_input = words.index_select(0, keep_idx).view(-1, 1)
+            live_rows = keep
+            if len(completed_scores) > 0 and max(completed_scores) >= float(scores[0]):
+                ran_out = False
+                break
+        if ran_out:
+            live_scores: List[float] = scores.tolist()
+            for j in range(len(live_rows)):
+                completed_scores.append(live_scores[j])
+                completed_steps.append(len(words_per_step) - 1)
+                completed_rows.append(live_rows[j])
+
+        translation: List[int] = []
+        if len(completed_scores) == 0:
+            return translation
+        best = 0
+        for i in range(len(completed_scores)):
+            if completed_scores[i] > completed_scores[best]:
+                best = i
+        step = completed_steps[best]
+        row = completed_rows[best]
+        while step >= 0:
+            translation.append(words_per_step[step][row])
+            row = parents_per_step[step][row]
+            step -= 1
+        translation.reverse()
+        return translation
+
+    def forward(self, src: torch.Tensor, max_length: int, k: int) -> List[int]:
+        """ k <= 1 is greedy search, otherwise beam search with beam size k """
+        if k <= 1:
+            return self.greedy(src, max_length)
+        return self.beam(src, max_length, k)
+
+
+def export_translator(encoder, decoder, path):
+    scripted = torch.jit.script(ScriptedTranslator(encoder.cpu().eval(), decoder.cpu().eval()))
+    scripted.save(path)
+    return scripted
+
+
+def load_translator(path):
+    return torch.jit.load(path, map_location="cpu")
+
+
+def translate(translator, sentence, max_length, target_lang, k=1):
+    """ @returns list of words in the target language, like generate_translation """
+    with torch.no_grad():
+        idx = translator(sentence.view(-1).cpu(), max_length, k)
+    return [target_lang.index2word[i] for i in idx]
+
+
+def check_and_time(translator, encoder, decoder, pairs, target_lang, k=1):
+    """
+    Compares the scripted translations with the eager ones on pairs.
+    @returns # of mismatches, eager and scripted seconds per sentence
+    """
+    search = "greedy" if k <= 1 else "beam"
+    mismatches = 0
+    eager_time, scripted_time = 0.0, 0.0
+    # the first calls of a scripted module are profiled and optimized, keep them out of the timing
+    for _ in range(3):
+        translate(translator, pairs[0][0], len(pairs[0][0]), target_lang, k=k)
+    for sentence, _ in pairs:
+        sentence = sentence.cpu()
+        start = time.time()
+        eager = generate_translation(encoder, decoder, sentence, len(sentence), target_lang, search=search, k=k)
+        eager_time += time.time() - start
+        start = time.time()
+        scripted = translate(translator, sentence, len(sentence), target_lang, k=k)
+        scripted_time += time.time() - start
+        if eager != scripted:
+            mismatches += 1
+    return mismatches, eager_time / len(pairs), scripted_time / len(pairs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang")
+    parser.add_argument("--target_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--pairs", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_validation_tokenized")
+    parser.add_argument("--encoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingencodermodel_states")
+    parser.add_argument("--decoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingdecodermodel_states")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--out", default="output/translator.pt")
+    parser.add_argument("--n", type=int, default=200, help="# of validation pairs to check")
+    args = parser.parse_args()
+
+    input_lang = pickle.load(open(args.input_lang, "rb"))
+    target_lang = pickle.load(open(args.target_lang, "rb"))
+    pairs = pickle.load(open(args.pairs, "rb"))[:args.n]
+
+    start = time.time()
+    encoder = Encoder_Batch_RNN(input_lang.n_words, args.hidden_size)
+    encoder.load_state_dict(torch.load(args.encoder, map_location="cpu"))
+    decoder = Decoder_RNN(target_lang.n_words, args.hidden_size)
+    decoder.load_state_dict(torch.load(args.decoder, map_location="cpu"))
+    eager_startup = time.time() - start
+    encoder.eval()
+    decoder.eval()
+
+    export_translator(encoder, decoder, args.out)
+    start = time.time()
+    translator = load_translator(args.out)
+    scripted_startup = time.time() - start
+    print("startup: eager %.3fs, scripted %.3fs" % (eager_startup, scripted_startup))
+
+    for k in [1, 5]:
+        mismatches, eager_latency, scripted_latency = check_and_time(translator, encoder, decoder, pairs, target_lang, k=k)
+        print("k=%d: %d/%d translations differ from eager, %.2fms -> %.2fms per sentence" % (
+            k, mismatches, len(pairs), eager_latency * 1000, scripted_latency * 1000))
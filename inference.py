@@ -5,7 +5,9 @@ import torch.nn.functional as F
 from data_prep import tensorFromSentence
 import numpy as np
 import pickle
+import math
 from random import randint
+from bleu import BleuAccumulator, reference_ids
 
 PAD_token = 0
 SOS_token = 1
@@ -14,11 +16,83 @@ UNK_token = 3
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def greedy_search(decoder, decoder_input, hidden, max_length):
+def set_device(new_device):
+    """
+    Where decoding (and model_architectures' encoders) create their tensors. Defaults to the GPU when there
+    is one; quantized models (quantization.py) run on CPU only, so they set "cpu"
+    """
+    global device
+    import model_architectures
+    device = torch.device(new_device)
+    model_architectures.device = device
+
+
+def decoder_step(decoder, decoder_input, hidden, projection=None, memory=None):
+    # decoders only get the shortlist projection when there is one, so the
+    # (input, hidden) signature keeps working for everything else
+    if memory is not None:
+        if projection is not None:
+            raise ValueError("the attention decoder can't use a shortlist projection")
+        # attention decoders (LuongAttnDecoderRNN) also get the encoder outputs and their mask.
+        # The beams of a sentence share its encoder outputs through expanded views, not copies
+        encoder_outputs, encoder_mask = memory
+        rows = hidden.size(1)
+        return decoder(decoder_input, hidden, encoder_outputs.expand(rows, -1, -1), encoder_mask.expand(rows, -1))
+    if projection is None:
+        return decoder(decoder_input, hidden)
+    return decoder(decoder_input, hidden, projection)
+
+
+def uses_attention(decoder):
+    return hasattr(decoder, "attn")
+
+
+def attention_memory(encoder_output, lengths):
+    """
+    What an attention decoder attends over.
+    @param encoder_output: batch_size x max_n x hidden_size tensor in the order of the batch (Attention.py's
+                           encoder) or the PackedSequence of model_architectures.Encoder_Batch_RNN, which is
+                           in descending length order
+    @param lengths: source length of every row of the batch
+    @returns encoder_outputs, encoder_mask: batch_size x max_n x hidden_size and batch_size x max_n,
+             the mask is False at padded positions
+    """
+    lengths = [int(length) for length in lengths]
+    if isinstance(encoder_output, torch.nn.utils.rnn.PackedSequence):
+        encoder_output, _ = torch.nn.utils.rnn.pad_packed_sequence(encoder_output, batch_first=True)
+        # same sort as Encoder_Batch_RNN.forward
+        descending_indices = [x for _, x in sorted(zip(lengths, range(len(lengths))), reverse=True)]
+        change_it_back = [x for _, x in sorted(zip(descending_indices, range(len(descending_indices))))]
+        encoder_output = encoder_output.index_select(0, torch.tensor(change_it_back, device=encoder_output.device))
+    positions = torch.arange(encoder_output.size(1), device=encoder_output.device)
+    encoder_mask = positions.unsqueeze(0) < torch.tensor(lengths, device=encoder_output.device).unsqueeze(1)
+    return encoder_output, encoder_mask
+
+
+def supports_shortlist(decoder):
+    return hasattr(decoder, "shortlist_projection")
+
+
+def shortlist_projection(decoder, vocab_subset):
+    if vocab_subset is None:
+        return None
+    if not supports_shortlist(decoder):
+        raise ValueError("%s has no shortlist_projection, a Shortlist only works with Decoder_RNN"
+                         % type(decoder).__name__)
+    return decoder.shortlist_projection(vocab_subset)
+
+
+def greedy_search(decoder, decoder_input, hidden, max_length, target_lang, vocab_subset=None, memory=None):
+    # vocab_subset is an optional sorted LongTensor of the target ids the decoder may pick from
+    # memory is the (encoder_outputs, encoder_mask) pair from attention_memory for attention decoders
+    projection = shortlist_projection(decoder, vocab_subset)
     translation = []
     for i in range(max_length):
-        next_word_softmax, hidden = decoder(decoder_input, hidden)
-        best_idx = torch.max(next_word_softmax, 1)[1].squeeze().item()
+        next_word_softmax, hidden = decoder_step(decoder, decoder_input, hidden, projection, memory)
+        best_idx = torch.max(next_word_softmax, 1)[1].squeeze()
+        if vocab_subset is not None:
+            best_idx = vocab_subset[best_idx]
+        best_idx = best_idx.item()
 
         # convert idx to word
         best_word = target_lang.index2word[best_idx]
@@ -30,50 +104,300 @@ def greedy_search(decoder, decoder_input, hidden, max_length):
     return translation
 
 
-def beam_search(decoder, decoder_input, hidden, max_length, k, target_lang):
-    
-    candidates = [(decoder_input, 0, hidden)]
-    potential_candidates = []
-    completed_translations = []
+def batch_greedy_search(decoder, decoder_input, hidden, max_lengths, vocab_subset=None, memory=None):
+    """
+    Greedy decoding for a whole batch at once. Rows that emitted EOS (or hit their own max length)
+    are masked out and we stop as soon as every row is done, so there is one host sync per step
+    instead of one per token per sentence.
+    @param decoder_input: batch_size x 1 tensor of SOS
+    @param hidden: 1 x batch_size x hidden_size encoder states
+    @param max_lengths: list with the max # of words the decoder can return for each row
+    @param vocab_subset: optional sorted LongTensor of the target ids the decoder may pick from
+    @param memory: (encoder_outputs, encoder_mask) from attention_memory, for attention decoders
+    @returns decoded: list of index lists, each one ends with EOS if it was produced
+    """
+    projection = shortlist_projection(decoder, vocab_subset)
+    batch_size = decoder_input.size(0)
+    max_lengths = torch.tensor(max_lengths, device=device)
+    longest = int(max_lengths.max())
+    output = torch.full((batch_size, longest), PAD_token, dtype=torch.long, device=device)
+    output_lengths = torch.zeros(batch_size, dtype=torch.long, device=device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+    for i in range(longest):
+        next_word_softmax, hidden = decoder_step(decoder, decoder_input, hidden, projection, memory)
+        best_idx = torch.max(next_word_softmax, 1)[1]
+        if vocab_subset is not None:
+            best_idx = vocab_subset.index_select(0, best_idx)
+        # finished rows are fed PAD and their output is ignored
+        best_idx = best_idx.masked_fill(finished, PAD_token)
+        output[:, i] = best_idx
+        output_lengths += (~finished).long()
+        finished = finished | (best_idx == EOS_token) | (max_lengths <= i + 1)
+        if bool(finished.all()):
+            break
+        decoder_input = best_idx.view(-1, 1)
+    return [row[:length] for row, length in zip(output.tolist(), output_lengths.tolist())]
+
+
+def pad_sentences(sentences):
+    """
+    Stacks a list of (n, 1) token tensors into a batch_size x max_n tensor padded with PAD_token
+    so it can go through Encoder_Batch_RNN in one call.
+    """
+    lengths = [s.size(0) for s in sentences]
+    padded = torch.nn.utils.rnn.pad_sequence([s.view(-1) for s in sentences], batch_first=True, padding_value=PAD_token)
+    return padded.to(device), lengths
+
+
+def beam_search(decoder, decoder_input, hidden, max_length, k, target_lang, relative_threshold=None,
+                absolute_threshold=None, max_per_parent=None, early_stop=True, vocab_subset=None, memory=None):
+    """
+    Beam search that pushes every live hypothesis through the decoder in a single call per step.
+    Instead of copying the sequence for each candidate we keep, for every step, the chosen word
+    and a backpointer to the row it was expanded from, and rebuild the winner at the end.
+    Pruning follows Freitag & Al-Onaizan (2017), "Beam Search Strategies for Neural Machine Translation".
+    @param decoder_input: 1 x 1 tensor holding SOS
+    @param hidden: 1 x 1 x hidden_size encoder state
+    @param relative_threshold: drop candidates whose probability is below relative_threshold * the best one's (0 < rp <= 1)
+    @param absolute_threshold: drop candidates whose log probability is more than absolute_threshold below the best one's
+    @param max_per_parent: max # of candidates that can come from the same hypothesis in one step
+    @param early_stop: stop once the best finished hypothesis scores higher than every live one.
+                       Scores only go down as hypotheses grow, so this never changes the result.
+    @param vocab_subset: optional sorted LongTensor of the target ids the decoder may pick from
+    @param memory: (encoder_outputs, encoder_mask) of the sentence from attention_memory, for attention decoders
+    @returns final_translation: list of words in the target language (ends with EOS if it was produced)
+    """
+    projection = shortlist_projection(decoder, vocab_subset)
+    scores = torch.zeros(1, device=device)
+    words_per_step = []  # words_per_step[t][j] is the word picked by row j at step t
+    parents_per_step = []  # parents_per_step[t][j] is the row at step t - 1 that row j extends
+    completed = []  # (score, step, row) for every hypothesis that emitted EOS
+    best_completed = None
+    live_rows = [0]  # rows of the previous step that are still being extended
 
-    # put a cap on the length of generated sentences
     for m in range(max_length):
-        for c in candidates:
-            # unpack the tuple
-            c_sequence = c[0]
-            c_score = c[1]
-            c_hidden = c[2]
-            # EOS token
-            if c_sequence[-1] == EOS_token:
-                completed_translations.append((c_sequence, c_score))
-                k = k - 1
+        next_word_probs, hidden = decoder_step(decoder, decoder_input, hidden, projection, memory)
+        vocab_size = next_word_probs.size(1)
+        # at most k candidates of a single hypothesis can make it into the beam anyway
+        per_parent = min(k if max_per_parent is None else min(k, max_per_parent), vocab_size)
+        parent_scores, parent_words = torch.topk(scores.unsqueeze(1) + next_word_probs, per_parent, dim=1)
+        # the candidates of every hypothesis are flattened so one topk covers the whole beam
+        top_scores, top_idx = torch.topk(parent_scores.view(-1), min(k, parent_scores.numel()))
+        parents = top_idx // per_parent
+        words = parent_words.view(-1).index_select(0, top_idx)
+        if vocab_subset is not None:
+            words = vocab_subset.index_select(0, words)
+        if relative_threshold is not None or absolute_threshold is not None:
+            # top_scores is sorted, so pruning keeps a prefix of the candidates
+            threshold = top_scores[0].item()
+            if absolute_threshold is not None:
+                threshold = threshold - absolute_threshold
+            if relative_threshold is not None:
+                threshold = max(threshold, top_scores[0].item() + math.log(relative_threshold))
+            n_kept = int((top_scores >= threshold).sum())
+            top_scores, parents, words = top_scores[:n_kept], parents[:n_kept], words[:n_kept]
+
+        words_list = words.tolist()
+        parents_list = parents.tolist()
+        words_per_step.append(words_list)
+        parents_per_step.append([live_rows[p] for p in parents_list])
+
+        keep = []
+        for j, word in enumerate(words_list):
+            if word == EOS_token:
+                completed.append((top_scores[j].item(), m, j))
+                if best_completed is None or completed[-1][0] > best_completed:
+                    best_completed = completed[-1][0]
             else:
-                next_word_probs, hidden = decoder(c_sequence[-1], c_hidden)
-                # in the worst-case, one sequence will have the highest k probabilities
-                # so to save computation, only grab the k highest_probability from each candidate sequence
-                top_probs, top_idx = torch.topk(next_word_probs, k)
-                for i in range(len(top_probs[0])):
-                    word = torch.from_numpy(np.array([top_idx[0][i]]).reshape(1, 1)).to(device)
-                    new_score = c_score + top_probs[0][i]
-                    potential_candidates.append((torch.cat((c_sequence, word)).to(device), new_score, c_hidden))
-
-        candidates = sorted(potential_candidates, key= lambda x: x[1])[0:k] 
-        potential_candidates = []
-
-    completed = completed_translations + candidates
-    completed = sorted(completed, key= lambda x: x[1], reverse=True)[0] 
-    #it's quite weird that it's not learning  what to do without the. . . 
-    final_translation = []
-    for x in completed[0]:
-        final_translation.append(target_lang.index2word[x.squeeze().item()])
+                keep.append(j)
+        # every finished hypothesis shrinks the beam, like the original implementation
+        k = k - (len(words_list) - len(keep))
+        if k <= 0 or len(keep) == 0:
+            break
+
+        keep_idx = torch.tensor(keep, device=device)
+        scores = top_scores.index_select(0, keep_idx)
+        hidden = hidden.index_select(1, parents.index_select(0, keep_idx))
+        decoder_input = words.index_select(0, keep_idx).view(-1, 1)
+        live_rows = keep
+        if early_stop and best_completed is not None and best_completed >= scores[0].item():
+            break
+    else:
+        # ran out of steps, the unfinished hypotheses compete with the finished ones
+        for j, row in enumerate(live_rows):
+            completed.append((scores[j].item(), len(words_per_step) - 1, row))
+
+    if len(completed) == 0:
+        return []
+    best_score, step, row = max(completed, key=lambda x: x[0])
+    best_idx = []
+    while step >= 0:
+        best_idx.append(words_per_step[step][row])
+        row = parents_per_step[step][row]
+        step -= 1
+    best_idx.reverse()
+    final_translation = [target_lang.index2word[idx] for idx in best_idx]
     return final_translation
 
 
-def generate_translation(encoder, decoder, sentence, max_length, target_lang, search="greedy", k = None):
+def batch_beam_search(decoder, hidden, max_lengths, k, relative_threshold=None, absolute_threshold=None,
+                      max_per_parent=None, early_stop=True, memory=None):
+    """
+    beam_search for a whole batch: the live hypotheses of every sentence are stacked into a single decoder
+    call per step, and one topk over a batch_size x (hypotheses x candidates) grid picks the beam of every
+    sentence. Each sentence keeps its own beam size, pruning, finished hypotheses and max length, and drops
+    out of the stack once it is done, so the translations are the ones beam_search gives row by row.
+    @param hidden: 1 x batch_size x hidden_size encoder states
+    @param max_lengths: list with the max # of words the decoder can return for each row
+    @param memory: (encoder_outputs, encoder_mask) of the batch from attention_memory, for attention decoders
+    the pruning options are beam_search's
+    @returns decoded: list of index lists, each one ends with EOS if it was produced
+    """
+    batch_size = hidden.size(1)
+    beams = [k] * batch_size  # beam size left for every sentence, finished hypotheses shrink it
+    done = [max_length <= 0 for max_length in max_lengths]
+    row_sentences = [s for s in range(batch_size) if not done[s]]  # sentence of every live row, grouped by sentence
+    row_index = torch.tensor(row_sentences, dtype=torch.long, device=device)
+    hidden = hidden.index_select(1, row_index)
+    scores = torch.zeros(len(row_sentences), device=device)
+    decoder_input = torch.full((len(row_sentences), 1), SOS_token, dtype=torch.long, device=device)
+    words_per_step = []  # words_per_step[t][c] is the word of candidate c (of any sentence) at step t
+    parents_per_step = []  # parents_per_step[t][c] is the candidate at step t - 1 that candidate c extends
+    completed = [[] for _ in range(batch_size)]  # (score, step, candidate) for every hypothesis that emitted EOS
+    best_completed = [None] * batch_size
+    live_rows = [0] * len(row_sentences)  # candidate of the previous step every live row extends
+
+    m = 0
+    while len(row_sentences) > 0:
+        row_memory = None
+        if memory is not None:
+            # every hypothesis attends over its own sentence
+            row_memory = (memory[0].index_select(0, row_index), memory[1].index_select(0, row_index))
+        next_word_probs, hidden = decoder_step(decoder, decoder_input, hidden, None, row_memory)
+        vocab_size = next_word_probs.size(1)
+        sentences = sorted(set(row_sentences))
+        per_parent = [0] * batch_size
+        for s in sentences:
+            per_parent[s] = min(beams[s] if max_per_parent is None else min(beams[s], max_per_parent), vocab_size)
+        widest = max(per_parent)
+        parent_scores, parent_words = torch.topk(scores.unsqueeze(1) + next_word_probs, widest, dim=1)
+        # rows whose sentence takes fewer candidates per hypothesis have the extra ones masked out
+        columns = torch.arange(widest, device=device)
+        row_per_parent = torch.tensor(per_parent, device=device).index_select(0, row_index)
+        parent_scores = parent_scores.masked_fill(columns.unsqueeze(0) >= row_per_parent.unsqueeze(1), float("-inf"))
+
+        # the candidates of every sentence go in one row of the grid, in the order beam_search flattens them
+        slots = []
+        for j, sentence in enumerate(row_sentences):
+            slots.append(slots[-1] + 1 if j > 0 and row_sentences[j - 1] == sentence else 0)
+        n_slots = max(slots) + 1
+        slot_index = torch.tensor(slots, dtype=torch.long, device=device)
+        positions = (row_index * n_slots + slot_index).unsqueeze(1) * widest + columns.unsqueeze(0)
+        grid = torch.full((batch_size, n_slots * widest), float("-inf"), device=device)
+        grid.view(-1)[positions.view(-1)] = parent_scores.reshape(-1)
+        grid_rows = torch.zeros((batch_size, n_slots), dtype=torch.long, device=device)
+        grid_rows[row_index, slot_index] = torch.arange(len(row_sentences), device=device)
+        top_scores, top_idx = torch.topk(grid, min(max(beams[s] for s in sentences), grid.size(1)), dim=1)
+        parents = grid_rows.gather(1, top_idx // widest)
+        words = parent_words.view(-1).index_select(0, (parents * widest + top_idx % widest).view(-1)).view_as(parents)
+
+        # the candidates a sentence keeps are a prefix of its row of top_scores
+        beam_sizes = torch.tensor(beams, device=device).clamp(min=0)
+        kept = (torch.arange(top_scores.size(1), device=device).unsqueeze(0) < beam_sizes.unsqueeze(1)) & (top_scores > float("-inf"))
+        if relative_threshold is not None or absolute_threshold is not None:
+            threshold = top_scores[:, 0]
+            if absolute_threshold is not None:
+                threshold = threshold - absolute_threshold
+            if relative_threshold is not None:
+                threshold = torch.max(threshold, top_scores[:, 0] + math.log(relative_threshold))
+            kept = kept & (top_scores >= threshold.unsqueeze(1))
+
+        top_list, parents_list, words_list, kept_list = (top_scores.tolist(), parents.tolist(), words.tolist(),
+                                                         kept.tolist())
+        step_words, step_parents = [], []
+        next_rows = []  # (flat position in top_scores, sentence, candidate) of the hypotheses to extend
+        for s in sentences:
+            keep = []
+            for j in range(len(kept_list[s])):
+                if not kept_list[s][j]:
+                    continue
+                candidate = len(step_words)
+                step_words.append(words_list[s][j])
+                step_parents.append(live_rows[parents_list[s][j]])
+                if words_list[s][j] == EOS_token:
+                    completed[s].append((top_list[s][j], m, candidate))
+                    if best_completed[s] is None or completed[s][-1][0] > best_completed[s]:
+                        best_completed[s] = completed[s][-1][0]
+                else:
+                    keep.append((j, candidate))
+            # every finished hypothesis shrinks the beam, like beam_search
+            beams[s] -= sum(kept_list[s]) - len(keep)
+            if beams[s] <= 0 or len(keep) == 0:
+                continue
+            if early_stop and best_completed[s] is not None and best_completed[s] >= top_list[s][keep[0][0]]:
+                continue
+            if m + 1 >= max_lengths[s]:
+                # ran out of steps, the unfinished hypotheses compete with the finished ones
+                completed[s].extend((top_list[s][j], m, candidate) for j, candidate in keep)
+                continue
+            next_rows.extend((s * top_scores.size(1) + j, s, candidate) for j, candidate in keep)
+        words_per_step.append(step_words)
+        parents_per_step.append(step_parents)
+        m += 1
+        if len(next_rows) == 0:
+            break
+
+        flat = torch.tensor([row[0] for row in next_rows], dtype=torch.long, device=device)
+        scores = top_scores.view(-1).index_select(0, flat)
+        hidden = hidden.index_select(1, parents.view(-1).index_select(0, flat))
+        decoder_input = words.view(-1).index_select(0, flat).view(-1, 1)
+        row_sentences = [row[1] for row in next_rows]
+        row_index = torch.tensor(row_sentences, dtype=torch.long, device=device)
+        live_rows = [row[2] for row in next_rows]
+
+    decoded = []
+    for s in range(batch_size):
+        if len(completed[s]) == 0:
+            decoded.append([])
+            continue
+        best_score, step, candidate = max(completed[s], key=lambda x: x[0])
+        best_idx = []
+        while step >= 0:
+            best_idx.append(words_per_step[step][candidate])
+            candidate = parents_per_step[step][candidate]
+            step -= 1
+        best_idx.reverse()
+        decoded.append(best_idx)
+    return decoded
+
+
+def cache_options(beam_options, shortlist):
+    # everything besides the sentence, search, k and max_length that changes the translation
+    options = dict(beam_options or {})
+    if shortlist is not None:
+        options["shortlist"] = shortlist.path
+    return options
+
+
+def generate_translation(encoder, decoder, sentence, max_length, target_lang, search="greedy", k = None, cache=None, beam_options=None, shortlist=None):
     """ 
     @param max_length: the max # of words that the decoder can return
+    @param cache: optional TranslationCache, repeated sentences are not decoded again
+    @param beam_options: optional dict of pruning options for beam_search
+                         (relative_threshold, absolute_threshold, max_per_parent, early_stop)
+    @param shortlist: optional Shortlist, the decoder only scores the candidate words of the sentence
     @returns decoded_words: a list of words in target language
     """    
+    if search == 'beam' and k == None:
+        k = 5 # since k = 2 preforms badly
+    if beam_options is None:
+        beam_options = {}
+    if cache is not None:
+        key = cache.key(sentence, search, k, max_length, cache_options(beam_options, shortlist))
+        decoded_words = cache.get(key)
+        if decoded_words is not None:
+            return decoded_words
+
     with torch.no_grad():
         input_tensor = sentence
         input_length = sentence.size()[0]
@@ -85,15 +409,19 @@ def generate_translation(encoder, decoder, sentence, max_length, target_lang, se
         decoder_input = torch.tensor([[SOS_token]], device=device)  # SOS
         decoder_hidden = encoder_hidden
         decoded_words = []
+        vocab_subset = shortlist.candidates(sentence) if shortlist is not None else None
+        memory = attention_memory(encoder_output, [input_length]) if uses_attention(decoder) else None
         
         if search == 'greedy':
-            decoded_words = greedy_search(decoder, decoder_input, decoder_hidden, max_length)
+            decoded_words = greedy_search(decoder, decoder_input, decoder_hidden, max_length, target_lang,
+                                          vocab_subset=vocab_subset, memory=memory)
         elif search == 'beam':
-            if k == None:
-                k = 5 # since k = 2 preforms badly
-            decoded_words = beam_search(decoder, decoder_input, decoder_hidden, max_length, k, target_lang)  
+            decoded_words = beam_search(decoder, decoder_input, decoder_hidden, max_length, k, target_lang,
+                                        vocab_subset=vocab_subset, memory=memory, **beam_options)
 
-        return decoded_words
+    if cache is not None:
+        cache.put(key, decoded_words)
+    return decoded_words
 
 
 def evaluate(encoder, decoder, sentence,max_length,  max_length_generation, search="greedy"):
@@ -137,6 +465,109 @@ def evaluate(encoder, decoder, sentence,max_length,  max_length_generation, sear
         return decoded_words
 
 
+def generate_translation_batch(encoder, decoder, sentences, max_lengths, target_lang, search="greedy", k=None, beam_options=None, shortlist=None):
+    """
+    Translates several sentences with a single (packed) Encoder_Batch_RNN call.
+    Greedy and beam search decode the whole batch together (beam search with a shortlist decodes each
+    row from its slice of the batched encoder states). Attention decoders (LuongAttnDecoderRNN) attend over the encoder
+    outputs with the padded positions masked.
+    @param sentences: list of (n, 1) token tensors in the source language
+    @param max_lengths: list with the max # of words that the decoder can return for each sentence
+    @param shortlist: optional Shortlist, greedy search uses the union of the candidates of the batch
+    @returns decoded_words: a list of word lists in the target language, in the order of sentences
+    """
+    with torch.no_grad():
+        input_batch, input_lengths = pad_sentences(sentences)
+        encoder_output, encoder_hidden = encoder(input_batch, input_lengths)
+        memory = attention_memory(encoder_output, input_lengths) if uses_attention(decoder) else None
+        if search == 'greedy':
+            decoder_input = torch.full((len(sentences), 1), SOS_token, dtype=torch.long, device=device)
+            vocab_subset = shortlist.candidates(*sentences) if shortlist is not None else None
+            decoded = batch_greedy_search(decoder, decoder_input, encoder_hidden, max_lengths,
+                                          vocab_subset=vocab_subset, memory=memory)
+            return [[target_lang.index2word[idx] for idx in row] for row in decoded]
+        if k == None:
+            k = 5
+        if beam_options is None:
+            beam_options = {}
+        if shortlist is None:
+            decoded = batch_beam_search(decoder, encoder_hidden, max_lengths, k, memory=memory, **beam_options)
+            return [[target_lang.index2word[idx] for idx in row] for row in decoded]
+        # every sentence has its own shortlist, so its own output layer: those are decoded one by one
+        decoded_words = []
+        for i in range(len(sentences)):
+            decoder_input = torch.tensor([[SOS_token]], device=device)
+            decoder_hidden = encoder_hidden[:, i:i + 1].contiguous()
+            vocab_subset = shortlist.candidates(sentences[i]) if shortlist is not None else None
+            row_memory = None
+            if memory is not None:
+                # only the row's own (unpadded) positions
+                row_memory = (memory[0][i:i + 1, :input_lengths[i]], memory[1][i:i + 1, :input_lengths[i]])
+            decoded_words.append(beam_search(decoder, decoder_input, decoder_hidden, max_lengths[i], k, target_lang,
+                                             vocab_subset=vocab_subset, memory=row_memory, **beam_options))
+        return decoded_words
+
+
+def length_buckets(lengths, batch_size):
+    """
+    Sorts the indices of the sentences by length (longest first) and cuts them into buckets of
+    batch_size, so each bucket is padded as little as possible.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def join_words(decoded_words, bpe=None):
+    # with a BPE target vocabulary the subwords are glued back into words
+    if bpe is not None:
+        return bpe.decode(decoded_words)
+    return " ".join(decoded_words)
+
+
+def translate_pairs(encoder, decoder, search, encoder_inputs, lang2, max_lengths, batch_size=64, cache=None, beam_options=None, shortlist=None, bpe=None):
+    """
+    Translates encoder_inputs bucket by bucket and puts the translations back in the original order.
+    @param cache: optional TranslationCache, only the sentences it misses are decoded
+    @param beam_options: optional dict of pruning options for beam_search
+    @param shortlist: optional Shortlist to restrict the decoder's output layer
+    @param bpe: optional BPE of the target language, if lang2 is a subword vocabulary
+    @returns translated_predictions: list of strings, one per input
+    """
+    k = 5 if search == 'beam' else None
+    translated_predictions = [None] * len(encoder_inputs)
+    to_translate = list(range(len(encoder_inputs)))
+    repeats = {}  # index that gets decoded -> later indices with the same key
+    if cache is not None:
+        options = cache_options(beam_options, shortlist)
+        keys = [cache.key(e_input, search, k, max_lengths[i], options) for i, e_input in enumerate(encoder_inputs)]
+        first_seen = {}
+        to_translate = []
+        for i in range(len(encoder_inputs)):
+            if keys[i] in first_seen:
+                repeats[first_seen[keys[i]]].append(i)
+                continue
+            decoded_words = cache.get(keys[i])
+            if decoded_words is None:
+                first_seen[keys[i]] = i
+                repeats[i] = []
+                to_translate.append(i)
+            else:
+                translated_predictions[i] = join_words(decoded_words, bpe)
+    buckets = length_buckets([len(encoder_inputs[i]) for i in to_translate], batch_size)
+    for bucket in [[to_translate[j] for j in bucket] for bucket in buckets]:
+        decoded = generate_translation_batch(encoder, decoder, [encoder_inputs[i] for i in bucket],
+                                             [max_lengths[i] for i in bucket], lang2, search=search, k=k,
+                                             beam_options=beam_options, shortlist=shortlist)
+        for i, decoded_words in zip(bucket, decoded):
+            translated_predictions[i] = join_words(decoded_words, bpe)
+            if cache is not None:
+                cache.put(keys[i], decoded_words)
+                for j in repeats[i]:
+                    translated_predictions[j] = translated_predictions[i]
+                    cache.hits += 1
+    return translated_predictions
+
+
 import sacrebleu
 def calculate_bleu(predictions, labels):
     """
@@ -147,20 +578,42 @@ def calculate_bleu(predictions, labels):
     bleu = sacrebleu.raw_corpus_bleu(predictions, [labels], .01).score
     return bleu
 
-def test_model(encoder, decoder, search, test_pairs, lang2, max_length=None):
+def test_model(encoder, decoder, search, test_pairs, lang2, max_length=None, batch_size=64, cache=None, beam_options=None, shortlist=None, bpe=None):
     # for test, you only need the lang1 words to be tokenized,
     # lang2 words is the true labels
+    # if max_length is None, each sentence can generate as many words as its source has
+    # sentences are bucketed by length and each bucket is encoded in one call
+    # with bpe (the target BPE) the subwords are joined back into words before scoring against the references
     encoder_inputs = [pair[0] for pair in test_pairs]
     true_labels = [pair[1] for pair in test_pairs]
-    translated_predictions = []
-    for i in range(len(encoder_inputs)):
-        e_input = encoder_inputs[i]
-        if max_length is None:
-            max_length = len(e_input)
-        decoded_words = generate_translation(encoder, decoder, e_input, max_length, lang2, search=search)
-        translated_predictions.append(" ".join(decoded_words))
+    max_lengths = [len(e_input) if max_length is None else max_length for e_input in encoder_inputs]
+    translated_predictions = translate_pairs(encoder, decoder, search, encoder_inputs, lang2, max_lengths, batch_size=batch_size,
+                                             cache=cache, beam_options=beam_options, shortlist=shortlist, bpe=bpe)
     rand = randint(0, 100)
     print(translated_predictions[rand])
     print(true_labels[rand])
     bleurg = calculate_bleu(translated_predictions, true_labels)
-    return bleurg
\ No newline at end of file
+    return bleurg
+
+
+def validation_bleu(encoder, decoder, search, test_pairs, lang2, max_length=None, batch_size=64, accumulator=None, bpe=None):
+    """
+    Same score as test_model, but the BLEU statistics are accumulated on token ids bucket by bucket
+    so no hypothesis strings are kept around.
+    Pass in an accumulator to keep a running BLEU over several calls.
+    @param bpe: the target BPE if lang2 is a subword vocabulary. The references are split into subwords
+                and compared with the decoder's subwords, so the score is a subword BLEU (higher than
+                test_model's word BLEU with the same bpe), good for comparing checkpoints
+    @returns accumulator: BleuAccumulator, accumulator.score() is the corpus BLEU so far
+    """
+    if accumulator is None:
+        accumulator = BleuAccumulator()
+    word_ids = {word: idx for idx, word in lang2.index2word.items()}
+    encoder_inputs = [pair[0] for pair in test_pairs]
+    for bucket in length_buckets([len(e_input) for e_input in encoder_inputs], batch_size):
+        max_lengths = [len(encoder_inputs[i]) if max_length is None else max_length for i in bucket]
+        decoded = generate_translation_batch(encoder, decoder, [encoder_inputs[i] for i in bucket],
+                                             max_lengths, lang2, search=search)
+        for i, decoded_words in zip(bucket, decoded):
+            accumulator.add([word_ids[word] for word in decoded_words], reference_ids(lang2, test_pairs[i][1], bpe))
+    return accumulator
@@ -34,7 +34,8 @@ def save_model(encoder, decoder, title):
 def make_graph(encoder, decoder, val_accs, train_accs, title):
     print("SAVE")
     val_accs = np.array(val_accs) # this is the BLEU score. 
-    max_val = val_accs.max() 
+    # empty when no step was validated, NaN for the snapshots BackgroundValidator skipped
+    max_val = np.nanmax(val_accs) if val_accs.size else float("nan")
     train_accs = np.array(train_accs)
     link = title.replace(" ", "")
     pickle.dump(val_accs, open("output/"+link + "val_accuracies", "wb"))
@@ -44,14 +45,14 @@ def make_graph(encoder, decoder, val_accs, train_accs, title):
     num_in_epoch = np.shape(train_accs)[1]
     num_epochs = np.shape(train_accs)[0]
     x_vals_train = np.arange(0, num_epochs, 1.0/float(num_in_epoch))
-    num_in_epoch = np.shape(val_accs)[1]
-    num_epochs = np.shape(val_accs)[0]
-    x_vals_val = np.arange(0, num_epochs, 1.0/float(num_in_epoch))
     fig = plt.figure()
     plt.title(title)
     # plot the title of this data. 
     plt.plot(x_vals_train, train_accs.flatten(), label="Training Loss (NLLoss)")
-    plt.plot(x_vals_val, val_accs.flatten(), label="Validation Accuracy (BLEU score)")
+    if val_accs.size:
+        num_in_epoch = np.shape(val_accs)[1]
+        x_vals_val = np.arange(0, np.shape(val_accs)[0], 1.0/float(num_in_epoch))
+        plt.plot(x_vals_val, val_accs.flatten(), label="Validation Accuracy (BLEU score)")
     plt.legend(loc="lower right")
     plt.ylabel("Accuracy of Model")
     plt.xlabel("Epochs (Batch Size 32)")
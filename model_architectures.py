@@ -146,13 +146,28 @@ class Decoder_RNN(nn.Module):
         self.out = nn.Linear(hidden_size, output_size)
         self.softmax = nn.LogSoftmax(dim=1)
 
-    def forward(self, input, hidden):
-        embed = self.embedding(input).view(1, 1, -1)
+    def forward(self, input, hidden, projection=None):
+        # input is (batch_size, 1) or a single index, hidden is 1 x batch_size x hidden_size
+        # so beam search can push all of its live hypotheses through in one call
+        # projection is an optional (weight, bias) from shortlist_projection, then the
+        # log probabilities are only over the shortlisted words
+        embed = self.embedding(input).view(1, -1, self.hidden_size)
         embed = F.relu(embed)
         output, hidden = self.gru(embed, hidden)
-        output = self.softmax(self.out(output[0]))
+        if projection is None:
+            output = self.softmax(self.out(output[0]))
+        else:
+            output = self.softmax(F.linear(output[0], projection[0], projection[1]))
         return output, hidden
 
+    def shortlist_projection(self, vocab_subset):
+        # rows of the output layer for the target ids in vocab_subset (see shortlist.py)
+        weight, bias = self.out.weight, self.out.bias
+        if callable(weight):
+            # dynamically quantized Linear (see quantization.py) keeps int8 weights behind methods
+            weight, bias = weight().dequantize(), bias()
+        return weight.index_select(0, vocab_subset), bias.index_select(0, vocab_subset)
+
     def initHidden(self):
         return torch.zeros(1, 1, self.hidden_size, device=device)
 
@@ -179,6 +194,23 @@ class SupEncoder(nn.Module):
     
     def encode(self, src, src_mask):
         return self.encoder(self.src_embed(src), src_mask)
+
+
+class SupEncoderForDecoding(nn.Module):
+    """
+    Gives a SupEncoder the (outputs, hidden) interface of Encoder_Batch_RNN, so inference (test_model,
+    BackgroundValidator) can decode from it. Like selfattention_encoder's train, the decoder starts from
+    the encoding of the last token of each sentence. Shares the weights of the SupEncoder it wraps.
+    """
+    def __init__(self, encoder):
+        super(SupEncoderForDecoding, self).__init__()
+        self.encoder = encoder
+
+    def forward(self, sents, sent_lengths):
+        # one sentence at a time, SupEncoder's positional encoding doesn't broadcast over a batch
+        last_tokens = [self.encoder(sents[i, int(length) - 1:int(length)], None) for i, length in enumerate(sent_lengths)]
+        hidden = torch.cat(last_tokens, 1)  # 1 x batch_size x hidden_size, each row is 1 x 1 x hidden_size
+        return hidden.transpose(0, 1), hidden
     
 
 def clones(module, N):
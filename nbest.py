@@ -0,0 +1,157 @@
+import argparse
+import pickle
+import torch
+
+from model_architectures import Encoder_Batch_RNN, Decoder_RNN
+from data_prep import Lang  # the Lang pickles were written from __main__
+from inference import decoder_step, shortlist_projection, uses_attention, attention_memory, SOS_token, EOS_token, device
+
+# N-best lists for downstream rescoring.
+# Hypotheses live in a prefix trie: a node is one token plus a pointer to the node it extends, so
+# hypotheses with a common prefix share it and the trie grows by one node per expansion that makes it
+# into the beam, instead of every hypothesis holding its own copy of the sequence.
+# Decoder states are only kept for the frontier (one row per live node) and children are expanded from
+# their parent's row, so a state is computed once per node no matter how many hypotheses share it.
+# python nbest.py --n 10 --out test.nbest
+
+
+class HypothesisTrie:
+    """ node 0 is SOS, every other node stores its token, parent, the token's log prob and the path score """
+    def __init__(self):
+        self.tokens = [SOS_token]
+        self.parents = [-1]
+        self.token_scores = [0.0]
+        self.scores = [0.0]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def add(self, parent, token, token_score, score):
+        self.tokens.append(token)
+        self.parents.append(parent)
+        self.token_scores.append(token_score)
+        self.scores.append(score)
+        return len(self.tokens) - 1
+
+    def path(self, node):
+        """ @returns tokens, token_scores from the root (SOS excluded) down to node """
+        tokens, token_scores = [], []
+        while node > 0:
+            tokens.append(self.tokens[node])
+            token_scores.append(self.token_scores[node])
+            node = self.parents[node]
+        tokens.reverse()
+        token_scores.reverse()
+        return tokens, token_scores
+
+
+def nbest_search(decoder, decoder_input, hidden, max_length, k, n, target_lang, vocab_subset=None, memory=None):
+    """
+    Beam search that keeps the beam k wide and collects finished hypotheses until it has the n best ones.
+    @param decoder_input: 1 x 1 tensor holding SOS
+    @param hidden: 1 x 1 x hidden_size encoder state
+    @param k: beam size, n <= k makes sense
+    @param vocab_subset: optional sorted LongTensor of the target ids the decoder may pick from
+    @param memory: (encoder_outputs, encoder_mask) of the sentence from attention_memory, for attention decoders
+    @returns nbest: up to n (words, score, token_scores) tuples, best first. score is the sum of token_scores
+             (log probs); words end with EOS unless the hypothesis ran out of steps
+    """
+    projection = shortlist_projection(decoder, vocab_subset)
+    trie = HypothesisTrie()
+    live_nodes = [0]  # live_nodes[j] is the trie node of row j of hidden
+    scores = torch.zeros(1, device=device)
+    finished = []  # trie nodes that ended with EOS
+
+    for m in range(max_length):
+        next_word_probs, hidden = decoder_step(decoder, decoder_input, hidden, projection, memory)
+        per_parent = min(k, next_word_probs.size(1))
+        parent_scores, parent_words = torch.topk(scores.unsqueeze(1) + next_word_probs, per_parent, dim=1)
+        top_scores, top_idx = torch.topk(parent_scores.view(-1), min(k, parent_scores.numel()))
+        parents = top_idx // per_parent
+        words = parent_words.view(-1).index_select(0, top_idx)
+        token_scores = next_word_probs[parents, words]
+        if vocab_subset is not None:
+            words = vocab_subset.index_select(0, words)
+
+        keep = []
+        next_nodes = []
+        for j, (parent, word, token_score, score) in enumerate(zip(parents.tolist(), words.tolist(),
+                                                                   token_scores.tolist(), top_scores.tolist())):
+            node = trie.add(live_nodes[parent], word, token_score, score)
+            if word == EOS_token:
+                finished.append(node)
+            else:
+                keep.append(j)
+                next_nodes.append(node)
+        if len(keep) == 0:
+            live_nodes = []
+            break
+
+        keep_idx = torch.tensor(keep, device=device)
+        scores = top_scores.index_select(0, keep_idx)
+        hidden = hidden.index_select(1, parents.index_select(0, keep_idx))
+        decoder_input = words.index_select(0, keep_idx).view(-1, 1)
+        live_nodes = next_nodes
+        if len(finished) >= n:
+            # scores only go down, so once the n-th best finished hypothesis beats every live one we are done
+            nth_best = sorted([trie.scores[node] for node in finished], reverse=True)[n - 1]
+            if nth_best >= scores[0].item():
+                live_nodes = []
+                break
+    # hypotheses that ran out of steps compete with the finished ones
+    finished.extend(live_nodes)
+
+    finished.sort(key=lambda node: trie.scores[node], reverse=True)
+    nbest = []
+    for node in finished[:n]:
+        tokens, token_scores = trie.path(node)
+        nbest.append(([target_lang.index2word[idx] for idx in tokens], trie.scores[node], token_scores))
+    return nbest
+
+
+def generate_nbest(encoder, decoder, sentence, max_length, target_lang, k=5, n=5, shortlist=None):
+    """ same as inference.generate_translation but @returns the n-best list of nbest_search """
+    with torch.no_grad():
+        input_length = sentence.size()[0]
+        encoder_output, encoder_hidden = encoder(sentence.view(1, -1), torch.tensor([input_length]))
+        decoder_input = torch.tensor([[SOS_token]], device=device)
+        vocab_subset = shortlist.candidates(sentence) if shortlist is not None else None
+        memory = attention_memory(encoder_output, [input_length]) if uses_attention(decoder) else None
+        return nbest_search(decoder, decoder_input, encoder_hidden, max_length, k, n, target_lang,
+                            vocab_subset=vocab_subset, memory=memory)
+
+
+def write_nbest(encoder, decoder, pairs, target_lang, path, k=5, n=5, shortlist=None):
+    """
+    Writes the n-best lists in the Moses format, one hypothesis per line:
+    sentence index ||| translation ||| score ||| per-token scores
+    """
+    with open(path, "w") as f:
+        for i, (sentence, _) in enumerate(pairs):
+            for words, score, token_scores in generate_nbest(encoder, decoder, sentence, len(sentence), target_lang,
+                                                             k=k, n=n, shortlist=shortlist):
+                f.write("%d ||| %s ||| %.4f ||| %s\n" % (i, " ".join(words), score,
+                                                        " ".join("%.4f" % s for s in token_scores)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang")
+    parser.add_argument("--target_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--pairs", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_test_tokenized")
+    parser.add_argument("--encoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingencodermodel_states")
+    parser.add_argument("--decoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingdecodermodel_states")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--k", type=int, default=10, help="beam size")
+    parser.add_argument("--n", type=int, default=10, help="# of hypotheses per sentence")
+    parser.add_argument("--out", default="output/test.nbest")
+    args = parser.parse_args()
+
+    input_lang = pickle.load(open(args.input_lang, "rb"))
+    target_lang = pickle.load(open(args.target_lang, "rb"))
+    pairs = pickle.load(open(args.pairs, "rb"))
+    encoder = Encoder_Batch_RNN(input_lang.n_words, args.hidden_size).to(device)
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
+    decoder = Decoder_RNN(target_lang.n_words, args.hidden_size).to(device)
+    decoder.load_state_dict(torch.load(args.decoder, map_location=device))
+    write_nbest(encoder.eval(), decoder.eval(), pairs, target_lang, args.out, k=args.k, n=args.n)
@@ -0,0 +1,96 @@
+import argparse
+import filecmp
+import os
+import pickle
+import time
+
+from data_prep import prepareTrainCorpus, prepareTrainCorpusParallel, iterNonTrainPairs, writeCorpus, MAX_LENGTH
+from normalization import NORMALIZATION_VERSION
+from artifact_cache import ArtifactCache, ARTIFACT_ROOT
+
+# Preprocesses a language pair (train, dev and test) into the memmap corpus format and pickles the Langs,
+# with --workers processes. The outputs go to the artifact cache (artifact_cache.py), so running it again
+# with the same files and options does nothing, and training scripts find them with locate("iwslt-vi-eng").
+# python preprocess.py --lang vi --workers 8
+# python preprocess.py --lang vi --workers 8 --benchmark   (also runs the serial version and checks both agree)
+
+
+def input_files(lang1):
+    """ @returns {dataset: (source file, target file)} """
+    return {dataset: ("iwslt-" + lang1 + "-en/" + stem + ".tok." + lang1, "iwslt-" + lang1 + "-en/" + stem + ".tok.en")
+            for dataset, stem in [("train", "train"), ("validation", "dev"), ("test", "test")]}
+
+
+def build_artifact(lang1, workers, size=None, vocab_options=None, bpe=None, root=ARTIFACT_ROOT, name=None):
+    """
+    @returns the artifact directory, and whether it had to be built. It holds the corpora "train",
+             "validation" and "test" (see data_prep.MemmapCorpus) and the pickled "input_lang" / "target_lang"
+    """
+    files = input_files(lang1)
+    all_files = [path for pair in files.values() for path in pair]
+    if bpe is not None:
+        all_files += [b.path for b in bpe]
+    settings = {"lang": lang1, "size": size, "max_length": MAX_LENGTH, "normalization": NORMALIZATION_VERSION,
+                "vocab_options": vocab_options or {}, "bpe": bpe is not None}
+
+    def build(directory):
+        input_lang, target_lang, _ = prepareTrainCorpusParallel(files["train"][0], files["train"][1], lang1, "eng",
+                                                                os.path.join(directory, "train"), workers, size,
+                                                                vocab_options=vocab_options, bpe=bpe)
+        pickle.dump(input_lang, open(os.path.join(directory, "input_lang"), "wb"))
+        pickle.dump(target_lang, open(os.path.join(directory, "target_lang"), "wb"))
+        for dataset in ["validation", "test"]:
+            writeCorpus(iterNonTrainPairs(files[dataset][0], files[dataset][1], input_lang, target_lang, bpe),
+                        os.path.join(directory, dataset))
+        return {name: name for name in ["train", "validation", "test", "input_lang", "target_lang"]}
+
+    return ArtifactCache(root).build(name or "iwslt-" + lang1 + "-eng", all_files, settings, build)
+
+
+def output_paths(lang1, suffix=""):
+    directory = "preprocessed_data_no_elmo/iwslt-" + lang1 + "-eng/"
+    return (directory + "preprocessed_no_indices_pairs_train_tokenized" + suffix,
+            directory + "preprocessed_no_elmo_" + lang1 + "lang" + suffix,
+            directory + "preprocessed_no_elmo_englang" + suffix)
+
+
+def benchmark(input_file, target_file, lang1, workers, size=None, vocab_options=None, bpe=None):
+    prefix, _, _ = output_paths(lang1, "_benchmark")
+    start = time.time()
+    serial = prepareTrainCorpus(input_file, target_file, lang1, "eng", prefix + "_serial", size, vocab_options, bpe)
+    serial_time = time.time() - start
+    start = time.time()
+    parallel = prepareTrainCorpusParallel(input_file, target_file, lang1, "eng", prefix + "_parallel", workers, size,
+                                          vocab_options=vocab_options, bpe=bpe)
+    parallel_time = time.time() - start
+    same_langs = all(a.word2index == b.word2index and a.word2count == b.word2count for a, b in zip(serial[:2], parallel[:2]))
+    same_corpus = all(filecmp.cmp(prefix + "_serial" + ext, prefix + "_parallel" + ext, shallow=False) for ext in [".src", ".tgt", ".idx"])
+    print("serial %.1fs, %d workers %.1fs (%.2fx), same vocabularies: %s, same corpus: %s" % (
+        serial_time, workers, parallel_time, serial_time / parallel_time, same_langs, same_corpus))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang", default="vi")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--size", type=int, default=None, help="only the first size pairs")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--min_count", type=int, default=None, help="words seen fewer times become UNK")
+    parser.add_argument("--max_size", type=int, default=None, help="max vocabulary size, special tokens included")
+    parser.add_argument("--coverage", type=float, default=None, help="keep the words covering this fraction of the tokens")
+    parser.add_argument("--bpe", action="store_true", help="subwords, with the merges learned by bpe.py")
+    parser.add_argument("--name", default=None, help="manifest entry, iwslt-<lang>-eng by default")
+    args = parser.parse_args()
+    vocab_options = {name: getattr(args, name) for name in ["min_count", "max_size", "coverage"] if getattr(args, name) is not None}
+
+    input_file = "iwslt-" + args.lang + "-en/train.tok." + args.lang
+    target_file = "iwslt-" + args.lang + "-en/train.tok.en"
+    bpe = None
+    if args.bpe:
+        from bpe import BPE
+        bpe = tuple(BPE("preprocessed_data_no_elmo/iwslt-" + args.lang + "-eng/bpe_" + name + ".merges") for name in [args.lang, "en"])
+    if args.benchmark:
+        benchmark(input_file, target_file, args.lang, args.workers, args.size, vocab_options, bpe)
+    else:
+        directory, built = build_artifact(args.lang, args.workers, args.size, vocab_options, bpe, name=args.name)
+        print(("built " if built else "up to date: ") + directory)
@@ -0,0 +1,57 @@
+import argparse
+import pickle
+
+from data_prep import Lang, load_cpickle_gc
+
+# Coverage / softmax size report for pruned vocabularies (see Lang.prune), and writes a pruned Lang.
+# python prune_vocab.py --lang preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang
+# python prune_vocab.py --lang ... --min_count 2 --out preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang_min2
+
+SETTINGS = [
+    ("full", {}),
+    ("min_count 2", {"min_count": 2}),
+    ("min_count 5", {"min_count": 5}),
+    ("max_size 30000", {"max_size": 30000}),
+    ("max_size 20000", {"max_size": 20000}),
+    ("coverage 0.99", {"coverage": 0.99}),
+    ("coverage 0.98", {"coverage": 0.98}),
+    ("coverage 0.95", {"coverage": 0.95}),
+]
+
+
+def token_coverage(full_lang, lang):
+    """ fraction of the running words of full_lang's corpus that are not UNK with lang """
+    total = sum(full_lang.word2count.values())
+    covered = sum(count for word, count in full_lang.word2count.items() if word in lang.word2index)
+    return covered / float(total)
+
+
+def report(lang, hidden_size=256, settings=SETTINGS):
+    """
+    Prints, for every setting, the vocabulary size, the token coverage and how much smaller the
+    Decoder_RNN.out softmax (hidden_size x n_words weights + bias) and the embedding get.
+    """
+    print("%-16s %8s %9s %10s %12s" % ("setting", "n_words", "coverage", "softmax", "params saved"))
+    for name, options in settings:
+        pruned = lang.prune(**options)
+        saved = (lang.n_words - pruned.n_words) * (2 * hidden_size + 1)  # embedding row + out row + bias
+        print("%-16s %8d %8.2f%% %9.1f%% %12d" % (name, pruned.n_words, 100 * token_coverage(lang, pruned),
+                                                  100. * pruned.n_words / lang.n_words, saved))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--min_count", type=int, default=None)
+    parser.add_argument("--max_size", type=int, default=None)
+    parser.add_argument("--coverage", type=float, default=None)
+    parser.add_argument("--out", default=None, help="write the Lang pruned with the options above here")
+    args = parser.parse_args()
+
+    lang = load_cpickle_gc(args.lang)
+    report(lang, args.hidden_size)
+    if args.out is not None:
+        pruned = lang.prune(min_count=args.min_count, max_size=args.max_size, coverage=args.coverage)
+        pickle.dump(pruned, open(args.out, "wb"))
+        print("%s: %d -> %d words" % (args.out, lang.n_words, pruned.n_words))
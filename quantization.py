@@ -0,0 +1,78 @@
+import argparse
+import copy
+import io
+import pickle
+import time
+import torch
+import torch.nn as nn
+
+from model_architectures import Encoder_Batch_RNN, Decoder_RNN
+from data_prep import Lang  # the Lang pickles were written from __main__
+from inference import translate_pairs, calculate_bleu, set_device
+
+# Int8 dynamic quantization for CPU inference.
+# The weights of every nn.GRU and nn.Linear (the 256-dim GRUs and the vocabulary sized output layer)
+# are stored as int8 and the activations are quantized on the fly, so nothing needs calibrating.
+# Works on Encoder_Batch_RNN, Decoder_RNN and LuongAttnDecoderRNN. Quantized models run on CPU only, so
+# quantize_model also makes inference create its tensors on CPU (inference.set_device), GPU or not.
+# python quantization.py --pairs preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_test_tokenized
+
+
+def quantize_model(model):
+    """ @returns a copy of model with int8 GRU and Linear layers, for inference only. model itself is left alone """
+    set_device("cpu")
+    return torch.quantization.quantize_dynamic(copy.deepcopy(model).cpu().eval(), {nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def model_size(model):
+    """ # of bytes of the serialized state_dict """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+
+def compare(encoder, decoder, test_pairs, lang2, search="greedy", batch_size=64):
+    """
+    Translates the same test pairs with the fp32 and the int8 models and prints
+    BLEU, model size and sentences/sec for both.
+    """
+    # both run on CPU, so the comparison is fair (and the int8 ones can't run anywhere else)
+    encoder, decoder = encoder.cpu(), decoder.cpu()
+    models = [("fp32", encoder, decoder), ("int8", quantize_model(encoder), quantize_model(decoder))]
+    encoder_inputs = [pair[0].cpu() for pair in test_pairs]
+    true_labels = [pair[1] for pair in test_pairs]
+    max_lengths = [len(e_input) for e_input in encoder_inputs]
+    report = {}
+    for name, model_encoder, model_decoder in models:
+        start = time.time()
+        with torch.no_grad():
+            predictions = translate_pairs(model_encoder, model_decoder, search, encoder_inputs, lang2, max_lengths, batch_size=batch_size)
+        elapsed = time.time() - start
+        report[name] = {"bleu": calculate_bleu(predictions, true_labels),
+                        "size_mb": (model_size(model_encoder) + model_size(model_decoder)) / 2 ** 20,
+                        "sentences_per_sec": len(test_pairs) / elapsed}
+        print("%s  BLEU %6.2f  size %7.2f MB  %8.1f sentences/sec" % (
+            name, report[name]["bleu"], report[name]["size_mb"], report[name]["sentences_per_sec"]))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang")
+    parser.add_argument("--target_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--pairs", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_test_tokenized")
+    parser.add_argument("--encoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingencodermodel_states")
+    parser.add_argument("--decoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingdecodermodel_states")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--search", default="greedy")
+    parser.add_argument("--n", type=int, default=1000, help="# of test pairs to translate")
+    args = parser.parse_args()
+
+    input_lang = pickle.load(open(args.input_lang, "rb"))
+    target_lang = pickle.load(open(args.target_lang, "rb"))
+    test_pairs = pickle.load(open(args.pairs, "rb"))[:args.n]
+    encoder = Encoder_Batch_RNN(input_lang.n_words, args.hidden_size)
+    encoder.load_state_dict(torch.load(args.encoder, map_location="cpu"))
+    decoder = Decoder_RNN(target_lang.n_words, args.hidden_size)
+    decoder.load_state_dict(torch.load(args.decoder, map_location="cpu"))
+    compare(encoder.eval(), decoder.eval(), test_pairs, target_lang, search=args.search)
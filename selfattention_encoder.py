@@ -26,6 +26,7 @@ from data_prep import *
 from misc import timeSince, load_cpickle_gc
 from logistics import *
 from inference import *
+from background_validation import BackgroundValidator
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 BATCH_SIZE = 16
@@ -132,12 +133,17 @@ def trainIters(encoder, decoder,n_epochs, validation_pairs, pairs, lang1, lang2,
     decoder_optimizer = torch.optim.Adam(decoder.parameters(), lr=learning_rate)
     
     criterion = nn.NLLLoss(ignore_index=PAD_token)
+    # validation BLEU is computed in another process on a snapshot of the weights. SupEncoder only returns
+    # its outputs, the wrapper gives inference the (outputs, hidden) it decodes from
+    decoding_encoder = SupEncoderForDecoding(encoder)
+    validator = BackgroundValidator(decoding_encoder, decoder, validation_pairs, lang2, search, max_length=None)
     plot_loss =[]
     val_loss = []
     
     for i in range(n_epochs):
         plot_loss =[]
         val_loss = []
+        val_steps = []
         # framing it as a categorical loss function. 
         for iter in range(1, n_iters + 1):
             training_pair = training_pairs[iter - 1] 
@@ -158,61 +164,68 @@ def trainIters(encoder, decoder,n_epochs, validation_pairs, pairs, lang1, lang2,
                                              iter, iter / n_epochs * 100, print_loss_avg))
                 plot_loss.append(print_loss_avg)
                 plot_loss_total = 0
-                with torch.no_grad():
-                    v_loss = test_model(encoder, decoder, search, validation_pairs, lang2, max_length=None, no_attention=False)
-                # returns bleu score
-                print("VALIDATION BLEU SCORE: "+str(v_loss))
+                validator.submit((i, iter), decoding_encoder, decoder)
+                val_steps.append(iter)
+                # returns bleu score for the snapshots that are done, tagged with their step
+                for (v_epoch, v_iter), v_loss in validator.poll():
+                    print("VALIDATION BLEU SCORE (epoch %d iter %d): %s" % (v_epoch, v_iter, v_loss))
                 sys.stdin.flush()
-                val_loss.append(v_loss)
                 save_model(encoder,decoder, title)
+        # the graph needs every validation score of this epoch
+        for (v_epoch, v_iter), v_loss in validator.wait():
+            print("VALIDATION BLEU SCORE (epoch %d iter %d): %s" % (v_epoch, v_iter, v_loss))
+        val_loss = [validator.scores[(i, v_iter)] for v_iter in val_steps]
         plot_losses.append(plot_loss)
         val_losses.append(val_loss)
         save_model(encoder,decoder, title)
         make_graph(encoder, decoder, val_losses, plot_losses, title)
+    validator.close()
 
    
 
-train_idx_pairs = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_indices_pairs_train_tokenized")
-input_lang = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_elmo_zhlang")
-target_lang = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_elmo_englang")
-val_idx_pairs =  pickle.load(open("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_indices_pairs_validation_tokenized", 'rb'))
-hidden_size = 256
-# number of duplicate layers in encoder
-N = 1
-# number of heads
-h=8
-dropout=0.1
-"Helper: Construct a model from hyperparameters."
-attn = MultiHeadedAttention(h, hidden_size).cuda()
-ff = PositionwiseFeedForward(hidden_size,input_lang.n_words, dropout).cuda()
-position = PositionalEncoding(hidden_size, dropout).cuda()
-src_embed = nn.Sequential(Embeddings(hidden_size, input_lang.n_words), position).cuda()
-encoder1 = SupEncoder(Encoder(EncoderLayer(hidden_size, attn, ff, dropout), N),src_embed).cuda()
-
-decoder1 = Decoder_RNN(target_lang.n_words,hidden_size).cuda()
-args = {
-    'n_epochs': 10,
-    'learning_rate': 0.001,
-    'search': 'beam',
-    'encoder': encoder1,
-    'decoder': decoder1,
-    'lang1': input_lang, 
-    'lang2': target_lang,
-    "pairs":train_idx_pairs, 
-    "validation_pairs": val_idx_pairs[:200], 
-    "title": "Training Curve for Basic Self Encoder With LR = 0.0001",
-    "max_length": 100,
-    "max_length_generation": 20, 
-    "plot_every": 500, 
-    "print_every": 500
-}
-
-"""
-We follow https://arxiv.org/pdf/1406.1078.pdf 
-and use the Adadelta optimizer
-
-"""
-print(BATCH_SIZE)
-
-trainIters(**args)
+# the validation worker is spawned, so it must not re-run the training when it imports this file
+if __name__ == "__main__":
+    train_idx_pairs = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_indices_pairs_train_tokenized")
+    input_lang = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_elmo_zhlang")
+    target_lang = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_elmo_englang")
+    val_idx_pairs =  pickle.load(open("preprocessed_data_no_elmo/iwslt-zh-eng/preprocessed_no_indices_pairs_validation_tokenized", 'rb'))
+    hidden_size = 256
+    # number of duplicate layers in encoder
+    N = 1
+    # number of heads
+    h=8
+    dropout=0.1
+    "Helper: Construct a model from hyperparameters."
+    attn = MultiHeadedAttention(h, hidden_size).cuda()
+    ff = PositionwiseFeedForward(hidden_size,input_lang.n_words, dropout).cuda()
+    position = PositionalEncoding(hidden_size, dropout).cuda()
+    src_embed = nn.Sequential(Embeddings(hidden_size, input_lang.n_words), position).cuda()
+    encoder1 = SupEncoder(Encoder(EncoderLayer(hidden_size, attn, ff, dropout), N),src_embed).cuda()
+
+    decoder1 = Decoder_RNN(target_lang.n_words,hidden_size).cuda()
+    args = {
+        'n_epochs': 10,
+        'learning_rate': 0.001,
+        'search': 'beam',
+        'encoder': encoder1,
+        'decoder': decoder1,
+        'lang1': input_lang, 
+        'lang2': target_lang,
+        "pairs":train_idx_pairs, 
+        "validation_pairs": val_idx_pairs[:200], 
+        "title": "Training Curve for Basic Self Encoder With LR = 0.0001",
+        "max_length": 100,
+        "max_length_generation": 20, 
+        "plot_every": 500, 
+        "print_every": 500
+    }
+
+    """
+    We follow https://arxiv.org/pdf/1406.1078.pdf 
+    and use the Adadelta optimizer
+
+    """
+    print(BATCH_SIZE)
+
+    trainIters(**args)
 
@@ -0,0 +1,133 @@
+import argparse
+import numpy as np
+import torch
+
+from data_prep import load_cpickle_gc
+
+# Lexical shortlist for the decoder's output layer.
+# Offline we count which target words co-occur with each source word in the training pairs and keep
+# the ones most associated with it (Dice coefficient, so frequent words that co-occur with everything
+# don't crowd out the actual translations), leaving out the words that are always candidates.
+# At inference time the candidates of a sentence are the union of the rows of its source words plus
+# the most frequent target words, and Decoder_RNN only computes logits over those
+# (see Decoder_RNN.shortlist_projection).
+# python shortlist.py --pairs preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_train_tokenized --out vi_shortlist.npz
+
+N_SPECIAL = 4  # PAD, SOS, EOS and UNK are always candidates
+
+
+def cooccurrence_counts(pairs, target_vocab_size, chunk_size=5000):
+    """
+    @param pairs: list of (source tensor, target tensor) like the ones pickled by prepareDataInitial
+    @returns keys, counts: keys are source_id * target_vocab_size + target_id, counts the # of
+             sentence pairs in which the two words occur together
+    """
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    for start in range(0, len(pairs), chunk_size):
+        chunk_keys = []
+        for source, target in pairs[start:start + chunk_size]:
+            source_ids = np.unique(np.asarray(source, dtype=np.int64).ravel())
+            target_ids = np.unique(np.asarray(target, dtype=np.int64).ravel())
+            chunk_keys.append((source_ids[:, None] * target_vocab_size + target_ids[None, :]).ravel())
+        chunk_keys, chunk_counts = np.unique(np.concatenate(chunk_keys), return_counts=True)
+        # merge with what we have so far
+        all_keys = np.concatenate([keys, chunk_keys])
+        keys, inverse = np.unique(all_keys, return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([counts, chunk_counts]), minlength=len(keys)).astype(np.int64)
+    return keys, counts
+
+
+def sentence_frequencies(pairs, side, vocab_size):
+    """ @returns # of sentences of the given side (0 source, 1 target) every word occurs in """
+    frequencies = np.zeros(vocab_size, dtype=np.int64)
+    for pair in pairs:
+        frequencies[np.unique(np.asarray(pair[side], dtype=np.int64).ravel())] += 1
+    return frequencies
+
+
+def build_shortlist(pairs, source_vocab_size, target_vocab_size, per_word=50, n_frequent=500):
+    """
+    @param per_word: # of target words kept for every source word, on top of the frequent ones
+    @param n_frequent: # of most frequent target words that are candidates for every sentence
+    @returns indptr, indices, frequent: the table in CSR form (the candidates of source word s are
+             indices[indptr[s]:indptr[s + 1]]) and the frequent target words
+    """
+    target_counts = np.zeros(target_vocab_size, dtype=np.int64)
+    for _, target in pairs:
+        target_counts += np.bincount(np.asarray(target, dtype=np.int64).ravel(), minlength=target_vocab_size)
+    target_counts[:N_SPECIAL] = 0  # the special tokens are always candidates anyway
+    frequent = np.argsort(-target_counts, kind="stable")[:n_frequent].astype(np.int32)
+
+    keys, counts = cooccurrence_counts(pairs, target_vocab_size)
+    sources = keys // target_vocab_size
+    targets = keys % target_vocab_size
+    # the special and frequent words are candidates for every sentence, their rows would be wasted on them
+    always = np.zeros(target_vocab_size, dtype=bool)
+    always[:N_SPECIAL] = True
+    always[frequent] = True
+    kept = ~always[targets]
+    sources, targets, counts = sources[kept], targets[kept], counts[kept]
+    # Dice: 2 c(s, t) / (c(s) + c(t)), with c the # of sentences a word (or both) occurs in
+    source_frequencies = sentence_frequencies(pairs, 0, source_vocab_size)
+    target_frequencies = sentence_frequencies(pairs, 1, target_vocab_size)
+    dice = 2. * counts / (source_frequencies[sources] + target_frequencies[targets])
+    # rank the targets of every source word by association (ties by count), and keep the first per_word
+    order = np.lexsort((-counts, -dice, sources))
+    sources, targets = sources[order], targets[order]
+    group_start = np.searchsorted(sources, sources, side="left")
+    kept = (np.arange(len(sources)) - group_start) < per_word
+    sources, targets = sources[kept], targets[kept]
+    indptr = np.zeros(source_vocab_size + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=source_vocab_size))
+    indices = targets.astype(np.int32)
+    return indptr, indices, frequent
+
+
+def save_shortlist(path, indptr, indices, frequent):
+    np.savez_compressed(path, indptr=indptr, indices=indices, frequent=frequent)
+
+
+class Shortlist:
+    def __init__(self, path, device="cpu"):
+        tables = np.load(path)
+        self.path = path
+        self.device = device
+        self.indptr = tables["indptr"]
+        self.indices = tables["indices"]
+        self.base = np.union1d(np.arange(N_SPECIAL, dtype=np.int32), tables["frequent"])
+
+    def candidate_ids(self, source_ids):
+        """ @returns sorted numpy array of the target ids allowed for a sentence with these source ids """
+        source_ids = np.unique(np.asarray(source_ids, dtype=np.int64).ravel())
+        source_ids = source_ids[source_ids < len(self.indptr) - 1]
+        rows = [self.indices[self.indptr[s]:self.indptr[s + 1]] for s in source_ids]
+        return np.union1d(self.base, np.concatenate(rows) if rows else self.base)
+
+    def candidates(self, *sentences):
+        """
+        @param sentences: one or more source tensors (a batch shares the union of its candidates)
+        @returns vocab_subset: sorted LongTensor of target ids
+        """
+        source_ids = np.concatenate([sentence.view(-1).cpu().numpy() for sentence in sentences])
+        return torch.from_numpy(self.candidate_ids(source_ids).astype(np.int64)).to(self.device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pairs", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_train_tokenized")
+    parser.add_argument("--input_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang")
+    parser.add_argument("--target_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--out", default="preprocessed_data_no_elmo/iwslt-vi-eng/shortlist.npz")
+    parser.add_argument("--per_word", type=int, default=50)
+    parser.add_argument("--n_frequent", type=int, default=500)
+    args = parser.parse_args()
+
+    from data_prep import Lang  # the Lang pickles were written from __main__
+    input_lang = load_cpickle_gc(args.input_lang)
+    target_lang = load_cpickle_gc(args.target_lang)
+    pairs = load_cpickle_gc(args.pairs)
+    indptr, indices, frequent = build_shortlist(pairs, input_lang.n_words, target_lang.n_words,
+                                                per_word=args.per_word, n_frequent=args.n_frequent)
+    save_shortlist(args.out, indptr, indices, frequent)
+    print("%d source words, %d table entries, %d frequent words" % (input_lang.n_words, len(indices), len(frequent)))
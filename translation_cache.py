@@ -0,0 +1,92 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from collections import OrderedDict
+
+# Bounded LRU cache of translations that sits in front of generate_translation.
+# Repeated segments (applause/laughter lines, boilerplate) are only decoded once.
+# The key is the source token ids plus the decoding settings, so greedy and beam
+# translations of the same sentence don't collide.
+
+
+def checkpoint_fingerprint(*paths):
+    """
+    sha1 of the model checkpoint files (e.g. the encoder and decoder state files from save_model).
+    A cache file written for another checkpoint is ignored when it is loaded.
+    """
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+class TranslationCache:
+    def __init__(self, max_size=10000, path=None, checkpoint=None):
+        """
+        @param max_size: max # of translations kept, the least recently used one is dropped first
+        @param path: optional file the cache is loaded from and saved to
+        @param checkpoint: fingerprint of the model (see checkpoint_fingerprint), the file on disk is
+                           only used if it was written for the same checkpoint
+        """
+        self.max_size = max_size
+        self.path = path
+        self.checkpoint = checkpoint
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    @staticmethod
+    def key(sentence, search, k, max_length, beam_options=None):
+        """ sentence is the (n, 1) source tensor, beam_options the pruning options passed to beam_search """
+        options = tuple(sorted(beam_options.items())) if beam_options else ()
+        return (tuple(sentence.view(-1).tolist()), search, k, max_length, options)
+
+    def get(self, key):
+        """ @returns the cached list of words, or None """
+        words = self.entries.get(key)
+        if words is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return words
+
+    def put(self, key, words):
+        self.entries[key] = words
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate()}
+
+    def save(self, path=None):
+        """ writes to a temp file first so a crash never leaves a half written cache """
+        path = path or self.path
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"checkpoint": self.checkpoint, "entries": list(self.entries.items())}, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path=None):
+        path = path or self.path
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+        if saved["checkpoint"] != self.checkpoint:
+            # the model changed, so the stored translations are stale
+            return
+        for key, words in saved["entries"][-self.max_size:]:
+            self.entries[key] = words
@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import pickle
+import queue
+import socketserver
+import threading
+import time
+import traceback
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from model_architectures import Encoder_Batch_RNN, Decoder_RNN
+from data_prep import Lang, tensorFromSentence  # the Lang pickles were written from __main__
+from inference import generate_translation_batch, supports_shortlist, device
+from translation_cache import TranslationCache
+
+# Long-lived translation service with the models resident in memory.
+# Requests are queued and a single worker thread groups them into micro-batches: a batch is sent to
+# generate_translation_batch once the oldest request has waited max_wait seconds, or once adding the
+# next request would go over the token budget (batch size x longest source, i.e. including padding).
+# python translation_server.py --port 8000          (HTTP, on 127.0.0.1 unless --host says otherwise)
+# python translation_server.py --socket /tmp/mt.sock  (Unix socket)
+# curl -d '{"text": "..."}' localhost:8000/translate ; curl localhost:8000/stats
+
+
+class TranslationRequest:
+    def __init__(self, sentence, max_length):
+        self.sentence = sentence
+        self.max_length = max_length
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.words = None
+        self.error = None
+
+
+class LatencyTracker:
+    """ keeps the latencies of the last `size` requests """
+    def __init__(self, size=10000):
+        self.latencies = deque(maxlen=size)
+        self.batch_sizes = deque(maxlen=size)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.count += len(latencies)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            batch_sizes = np.array(self.batch_sizes)
+            count = self.count
+        if len(latencies) == 0:
+            return {"requests": count}
+        return {"requests": count,
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "mean_batch_size": float(batch_sizes.mean())}
+
+
+class MicroBatcher:
+    def __init__(self, encoder, decoder, target_lang, max_wait=0.01, max_tokens=4096, max_batch=128,
+                 search="greedy", cache=None, shortlist=None):
+        """
+        @param max_wait: max # of seconds the oldest request of a batch waits for more requests
+        @param max_tokens: token budget of a batch, batch size x longest source sentence
+        """
+        self.encoder = encoder
+        self.decoder = decoder
+        self.target_lang = target_lang
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.max_batch = max_batch
+        self.search = search
+        self.cache = cache
+        self.shortlist = shortlist
+        self.requests = queue.Queue()
+        self.latency = LatencyTracker()
+        self.held = None  # request that did not fit in the previous batch
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def translate(self, sentence, max_length):
+        """ called from the request threads, blocks until the translation is ready """
+        request = TranslationRequest(sentence, max_length)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.words
+
+    def next_batch(self):
+        first = self.held if self.held is not None else self.requests.get()
+        self.held = None
+        batch = [first]
+        longest = len(first.sentence)
+        deadline = first.arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if (len(batch) + 1) * max(longest, len(request.sentence)) > self.max_tokens:
+                self.held = request
+                break
+            batch.append(request)
+            longest = max(longest, len(request.sentence))
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                translations = self.translate_batch(batch)
+                for request, words in zip(batch, translations):
+                    request.words = words
+            except Exception as error:
+                # every request of the batch gets the error, its handler answers 500
+                traceback.print_exc()
+                for request in batch:
+                    request.error = error
+            finished = time.time()
+            self.latency.add_batch([finished - request.arrival for request in batch])
+            for request in batch:
+                request.done.set()
+
+    def translate_batch(self, batch):
+        translations = [None] * len(batch)
+        to_translate = list(range(len(batch)))
+        if self.cache is not None:
+            keys = [self.cache.key(request.sentence, self.search, None, request.max_length) for request in batch]
+            to_translate = []
+            for i in range(len(batch)):
+                translations[i] = self.cache.get(keys[i])
+                if translations[i] is None:
+                    to_translate.append(i)
+        if len(to_translate) > 0:
+            decoded = generate_translation_batch(self.encoder, self.decoder, [batch[i].sentence for i in to_translate],
+                                                 [batch[i].max_length for i in to_translate], self.target_lang,
+                                                 search=self.search, shortlist=self.shortlist)
+            for i, words in zip(to_translate, decoded):
+                translations[i] = words
+                if self.cache is not None:
+                    self.cache.put(keys[i], words)
+        return translations
+
+
+def make_handler(batcher, input_lang, max_length=None):
+    class TranslationHandler(BaseHTTPRequestHandler):
+        def send_json(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                stats = batcher.latency.stats()
+                if batcher.cache is not None:
+                    stats["cache"] = batcher.cache.stats()
+                self.send_json(200, stats)
+            else:
+                self.send_json(404, {"error": "unknown path"})
+
+        def do_POST(self):
+            if self.path != "/translate":
+                self.send_json(404, {"error": "unknown path"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                text = body["text"]
+            except (ValueError, KeyError):
+                self.send_json(400, {"error": "expected a JSON body with a \"text\" field"})
+                return
+            try:
+                sentence = tensorFromSentence(input_lang, text).to(device)
+                words = batcher.translate(sentence, len(sentence) if max_length is None else max_length)
+            except Exception as error:
+                self.send_json(500, {"error": "translation failed: %s: %s" % (type(error).__name__, error)})
+                return
+            if len(words) > 0 and words[-1] == "EOS":
+                words = words[:-1]
+            self.send_json(200, {"translation": " ".join(words)})
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return str(self.client_address[0]) if self.client_address else "unix"
+
+        def log_message(self, format, *args):
+            pass
+
+    return TranslationHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang")
+    parser.add_argument("--target_lang", default="preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang")
+    parser.add_argument("--encoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingencodermodel_states")
+    parser.add_argument("--decoder", default="output/TrainingCurveforBasic1-DirectionalEncoderDecoderModelWithLR=0.001nodecoderbatchingdecodermodel_states")
+    parser.add_argument("--hidden_size", type=int, default=256)
+    parser.add_argument("--host", default="127.0.0.1", help="only local clients by default, 0.0.0.0 to serve the network")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket", default=None, help="serve on this Unix socket instead of TCP")
+    parser.add_argument("--search", default="greedy")
+    parser.add_argument("--max_wait_ms", type=float, default=10)
+    parser.add_argument("--max_tokens", type=int, default=4096)
+    parser.add_argument("--cache_size", type=int, default=0)
+    parser.add_argument("--shortlist", default=None)
+    parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization (CPU only)")
+    args = parser.parse_args()
+
+    input_lang = pickle.load(open(args.input_lang, "rb"))
+    target_lang = pickle.load(open(args.target_lang, "rb"))
+    encoder = Encoder_Batch_RNN(input_lang.n_words, args.hidden_size).to(device)
+    encoder.load_state_dict(torch.load(args.encoder, map_location=device))
+    decoder = Decoder_RNN(target_lang.n_words, args.hidden_size).to(device)
+    decoder.load_state_dict(torch.load(args.decoder, map_location=device))
+    encoder.eval()
+    decoder.eval()
+    if args.quantize:
+        from quantization import quantize_model
+        encoder, decoder = quantize_model(encoder), quantize_model(decoder)
+        # quantize_model switched inference to CPU, the requests' tensors have to follow
+        device = torch.device("cpu")
+    cache = TranslationCache(args.cache_size) if args.cache_size > 0 else None
+    shortlist = None
+    if args.shortlist is not None:
+        if not supports_shortlist(decoder):
+            parser.error("--shortlist needs a decoder with shortlist_projection (Decoder_RNN), not %s"
+                         % type(decoder).__name__)
+        from shortlist import Shortlist
+        shortlist = Shortlist(args.shortlist, device=device)
+
+    batcher = MicroBatcher(encoder, decoder, target_lang, max_wait=args.max_wait_ms / 1000.,
+                           max_tokens=args.max_tokens, search=args.search, cache=cache, shortlist=shortlist)
+    handler = make_handler(batcher, input_lang)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ThreadingUnixHTTPServer(args.socket, handler)
+        print("serving on " + args.socket)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print("serving on %s:%d" % (args.host, args.port))
+    server.serve_forever()
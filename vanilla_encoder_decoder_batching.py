@@ -21,6 +21,9 @@ from model_architectures import *
 from data_prep import *
 from misc import timeSince, load_cpickle_gc
 from inference import *
+from background_validation import BackgroundValidator
+from artifact_cache import locate
+from batching import BucketBatchSampler, TokenBudgetBatchSampler, TokenMeter, pair_lengths, pad_batch
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -47,6 +50,7 @@ class Lang:
 
 
 BATCH_SIZE = 16
+MAX_TOKENS = None  # e.g. 2000: batches hold up to this many padded source + target tokens instead of BATCH_SIZE pairs
 PAD_token = 0
 SOS_token = 1
 EOS_token = 2
@@ -83,25 +87,8 @@ def language_pair_dataset_collate_function(batch):
     Customized function for DataLoader that dynamically pads the batch so that all 
     data have the same length
     """
-    sent1_list = []
-    sent1_length_list = []
-    sent2_list = []
-    sent2_length_list = []
-    # padding
-    # NOW PAD WITH THE MAXIMUM LENGTH OF THE FIRST and second batches 
-    max_length_1 = max([len(x[0]) for x in batch])
-    max_length_2 = max([len(x[1]) for x in batch])
-    for datum in batch:
-        padded_vec_1 = np.pad(np.array(datum[0]).T.squeeze(), pad_width=((0,max_length_1-len(datum[0]))), 
-                                mode="constant", constant_values=PAD_token)
-        padded_vec_2 = np.pad(np.array(datum[1]).T.squeeze(), pad_width=((0,max_length_2-len(datum[1]))), 
-                                mode="constant", constant_values=PAD_token)
-        sent1_list.append(padded_vec_1)
-        sent2_list.append(padded_vec_2)
-        sent1_length_list.append(len(datum[0]))
-        sent2_length_list.append(len(datum[1]))
-    return [torch.from_numpy(np.array(sent1_list)), torch.cuda.LongTensor(sent1_length_list), 
-            torch.from_numpy(np.array(sent2_list)), torch.cuda.LongTensor(sent2_length_list)]
+    # CPU tensors, the training loop moves them to the device. Pinned when there is a GPU to copy to
+    return pad_batch(batch, PAD_token, pin_memory=torch.cuda.is_available())
 
 
 def save_model(encoder, decoder, title):
@@ -112,7 +99,7 @@ def save_model(encoder, decoder, title):
 def make_graph(encoder, decoder, val_accs, train_accs, title):
     print("SAVE")
     val_accs = np.array(val_accs) # this is the BLEU score. 
-    max_val = val_accs.max() 
+    max_val = np.nanmax(val_accs) # NaN for the snapshots BackgroundValidator skipped 
     train_accs = np.array(train_accs)
     link = title.replace(" ", "")
     pickle.dump(val_accs, open("output/"+link + "val_accuracies", "wb"))
@@ -163,7 +150,7 @@ def train(sent1_batch,  sent1_length_batch, encoder, decoder, encoder_optimizer,
                 count += 1
                 decoder_output, decoder_hidden = decoder(decoder_input, decoder_hidden.view(1, 1, -1))
                 output_translation.append(decoder_output)
-                loss += criterion(decoder_output, torch.cuda.LongTensor([target_tensor[di]]) )# adding per each token. 
+                loss += criterion(decoder_output, target_tensor[di:di+1]) # adding per each token. 
                 decoder_input = target_tensor[di]  # Teacher forcing
                 if decoder_input == PAD_token: # so that it learns to predict EOS. 
                     break # since we are batching here
@@ -176,7 +163,7 @@ def train(sent1_batch,  sent1_length_batch, encoder, decoder, encoder_optimizer,
                 topv, topi = decoder_output.topk(1)
                 decoder_input = topi.squeeze().detach()  # detach from history as input
                 count += 1
-                loss += criterion(decoder_output, torch.cuda.LongTensor([target_tensor[di]]))
+                loss += criterion(decoder_output, target_tensor[di:di+1])
                 if decoder_input.item() == EOS_token:
                     break
         output_translations.append(output_translation)
@@ -207,17 +194,22 @@ def trainIters(encoder, decoder, n_epochs, pairs, validation_pairs, lang1, lang2
     #decoder_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(decoder_optimizer, mode="min")
 
     criterion = nn.NLLLoss(ignore_index=PAD_token) # this ignores the padded token. 
+    # validation BLEU is computed in another process on a snapshot of the weights
+    validator = BackgroundValidator(encoder, decoder, validation_pairs, lang2, search, max_length=max_length_generation)
     plot_loss =[]
     val_loss = []
+    tokens = TokenMeter()
     for epoch in range(n_epochs):
 
         plot_loss = []
         val_loss = []
+        val_steps = []
         for step, (sent1s, sent1_lengths, sent2s, sent2_lengths) in enumerate(train_loader):
             encoder.train() # what is this for?
             decoder.train()
-            sent1_batch, sent2_batch = sent1s.to(device), sent2s.to(device) 
-            sent1_length_batch, sent2_length_batch = sent1_lengths.to(device), sent2_lengths.to(device)
+            sent1_batch, sent2_batch = sent1s.to(device, non_blocking=True), sent2s.to(device, non_blocking=True) # the collate function pins them on GPU machines
+            sent1_length_batch, sent2_length_batch = sent1_lengths.to(device, non_blocking=True), sent2_lengths.to(device, non_blocking=True)
+            tokens.update(sent1_lengths, sent2_lengths)
             loss, output_translations, count = train(sent1_batch, sent1_length_batch, encoder, decoder, encoder_optimizer, decoder_optimizer, sent2_batch, sent2_length_batch, criterion, count) # Yikes, what is this. 
             i = 0  #look at the first output ranslation
             output = output_translations[i]
@@ -242,70 +234,94 @@ def trainIters(encoder, decoder, n_epochs, pairs, validation_pairs, lang1, lang2
                 print_loss_total = 0
                 print('TRAIN SCORE %s (%d %d%%) %.4f' % (timeSince(start, step / n_epochs),
                                              step, step / n_epochs * 100, print_loss_avg))
-                with torch.no_grad():
-                    v_loss = test_model(encoder, decoder, search, validation_pairs, lang2, max_length=max_length_generation)
-                # returns bleu score
-                print("VALIDATION BLEU SCORE: "+str(v_loss))
-                val_loss.append(v_loss)
+                print("%.0f tokens/sec" % tokens.tokens_per_sec())
+                tokens.reset()
+                validator.submit((epoch, step), encoder, decoder)
+                val_steps.append(step)
+                # returns bleu score for the snapshots that are done, tagged with their step
+                for (v_epoch, v_step), v_loss in validator.poll():
+                    print("VALIDATION BLEU SCORE (epoch %d step %d): %s" % (v_epoch, v_step, v_loss))
                 plot_loss.append(print_loss_avg)
                 # save it every time it hits the step now. 
                 save_model(encoder, decoder, title)
                 sys.stdin.flush()
                 plot_loss_total = 0
 
+        # the graph needs every validation score of this epoch
+        for (v_epoch, v_step), v_loss in validator.wait():
+            print("VALIDATION BLEU SCORE (epoch %d step %d): %s" % (v_epoch, v_step, v_loss))
+        val_loss = [validator.scores[(epoch, v_step)] for v_step in val_steps]
         plot_losses.append(plot_loss)
         val_losses.append(val_loss)
         print("AVERAGE PLOT LOSS")
         print(np.mean(plot_loss))
+        print("PADDING RATIO %.3f (%.3f without bucketing)" % train_loader.batch_sampler.padding_ratio())
         sys.stdin.flush()
         #encoder_scheduler.step(np.mean(plot_loss)) # this isnt' really doing anything. 
         #decoder_scheduler.step(np.mean(plot_loss))
         save_model(encoder, decoder, title)
         make_graph(encoder, decoder, val_losses, plot_losses, title)
+    validator.close()
     assert len(val_losses) == len(plot_losses)
     save_model(encoder, decoder, title)
     make_graph(encoder, decoder, val_losses, plot_losses, title)
 
-hidden_size = 256
-print(BATCH_SIZE)
-input_lang = pickle.load(open("preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang", "rb"))
-target_lang = pickle.load(open("preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang", "rb"))
-train_idx_pairs = load_cpickle_gc("preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_train_tokenized")
-val_pairs = pickle.load(open("preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_validation_tokenized", "rb"))
-train_dataset = LanguagePairDataset(train_idx_pairs)
-# is there anything in the train_idx_pairs that is only 0s right noww instea dof padding. 
-train_loader = torch.utils.data.DataLoader(dataset=train_dataset, 
-                                           batch_size=BATCH_SIZE, 
-                                           collate_fn=language_pair_dataset_collate_function,
-                                          )
+# the validation worker is spawned, so it must not re-run the training when it imports this file
+if __name__ == "__main__":
+    hidden_size = 256
+    print(BATCH_SIZE)
+    try:
+        # built by preprocess.py
+        artifacts = locate("iwslt-vi-eng")
+    except KeyError:
+        artifacts = {"input_lang": "preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_vilang",
+                     "target_lang": "preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_elmo_englang",
+                     "train": "preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_train_tokenized",
+                     "validation": "preprocessed_data_no_elmo/iwslt-vi-eng/preprocessed_no_indices_pairs_validation_tokenized"}
+    input_lang = pickle.load(open(artifacts["input_lang"], "rb"))
+    target_lang = pickle.load(open(artifacts["target_lang"], "rb"))
+    train_idx_pairs = loadPairs(artifacts["train"])
+    val_pairs = loadPairs(artifacts["validation"])
+    train_dataset = LanguagePairDataset(train_idx_pairs)
+    # is there anything in the train_idx_pairs that is only 0s right noww instea dof padding. 
+    # batches of similar lengths, reshuffled every epoch. The dataset truncates to MAX_LENGTH so the lengths are clipped too
+    lengths = pair_lengths(train_idx_pairs, max_length=MAX_LENGTH)
+    if MAX_TOKENS is not None:
+        train_sampler = TokenBudgetBatchSampler(*lengths, max_tokens=MAX_TOKENS)
+    else:
+        train_sampler = BucketBatchSampler(*lengths, batch_size=BATCH_SIZE)
+    train_loader = torch.utils.data.DataLoader(dataset=train_dataset, 
+                                               batch_sampler=train_sampler, 
+                                               collate_fn=language_pair_dataset_collate_function,
+                                              )
 
-encoder1 = Encoder_Batch_RNN(input_lang.n_words, hidden_size).to(device)
-decoder1 = Decoder_RNN(target_lang.n_words, hidden_size).to(device)
+    encoder1 = Encoder_Batch_RNN(input_lang.n_words, hidden_size).to(device)
+    decoder1 = Decoder_RNN(target_lang.n_words, hidden_size).to(device)
 
-args = {
-    'n_epochs': 10,
-    'learning_rate': 0.001,
-    'search': 'beam',
-    'encoder': encoder1,
-    'decoder': decoder1,
-    'lang1': input_lang, 
-    'lang2': target_lang,
-    "pairs":train_idx_pairs[10000:], 
-    "validation_pairs": val_pairs[:200], 
-    "title": "Training Curve for Basic 1-Directional Encoder Decoder Model With LR = 0.001 no decoder batching",
-    "max_length_generation": 2, 
-    "plot_every": 500, 
-    "print_every": 500
-}
+    args = {
+        'n_epochs': 10,
+        'learning_rate': 0.001,
+        'search': 'beam',
+        'encoder': encoder1,
+        'decoder': decoder1,
+        'lang1': input_lang, 
+        'lang2': target_lang,
+        "pairs":torch.utils.data.Subset(train_idx_pairs, range(10000, len(train_idx_pairs))), 
+        "validation_pairs": val_pairs[:200], 
+        "title": "Training Curve for Basic 1-Directional Encoder Decoder Model With LR = 0.001 no decoder batching",
+        "max_length_generation": 2, 
+        "plot_every": 500, 
+        "print_every": 500
+    }
 
-"""
-We take the input sentence as the length of the maximum generating sentence 
-We follow https://arxiv.org/pdf/1406.1078.pdf 
-and use the Adadelta optimizer
-Have max_length_generation
+    """
+    We take the input sentence as the length of the maximum generating sentence 
+    We follow https://arxiv.org/pdf/1406.1078.pdf 
+    and use the Adadelta optimizer
+    Have max_length_generation
 
-"""
-print(BATCH_SIZE)
+    """
+    print(BATCH_SIZE)
 
-trainIters(**args)
+    trainIters(**args)
 